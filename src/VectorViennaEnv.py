@@ -0,0 +1,491 @@
+from typing import Any, Iterable
+import inspect
+import time
+from warnings import warn
+import gymnasium as gym
+from gymnasium.vector import VectorEnv
+from gymnasium.utils import seeding
+from stable_baselines3.common.vec_env import VecEnv
+from ViennaEnv import ViennaEnv, state_dtypes, flat_layout, fill_graph_observation
+from distances import SharedMatrixInfo
+import numpy as np
+
+
+# values of ignored `ViennaEnv` options that the batched environment behaves like anyway, next
+# to their defaults. Its info always holds the clock & total travel time only.
+matching_options = {'info_level': ('none', 'minimal')}
+
+
+class VectorViennaEnv(VectorEnv):
+	def __init__(self,
+		num_envs: int = 10,
+		place_count: int = 80, vehicle_count: int = 10, package_count: int = 20,
+		shared_matrix: SharedMatrixInfo = None, observation_mode: str = 'dict',
+		**ignored_options
+	):
+		"""
+		Simulates `num_envs` copies of `ViennaEnv` at once. Instead of holding one environment
+		object per copy, every field of the environment dictionary is stored as a single array
+		of shape `(num_envs, vehicle_count)` or `(num_envs, package_count)` & all copies are
+		stepped together with numpy. Finished environments are reset in place.
+
+		The rules are the same as in `ViennaEnv.step` & `kernels.tick_kernel`, including
+		the pause after arriving & the order in which packages are picked up. Only the random
+		starting positions differ, as they are drawn from `self.np_random` instead of the
+		`random` module.
+
+		:param num_envs: Number of environments to simulate.
+		:param place_count: Same as in `ViennaEnv`.
+		:param vehicle_count: Same as in `ViennaEnv`.
+		:param package_count: Same as in `ViennaEnv`.
+		:param shared_matrix: Same as in `ViennaEnv`.
+		:param observation_mode: Same as in `ViennaEnv`, the flat observations are stacked into
+			an array of shape `(num_envs, observation size)` & each graph observation array gets
+			the environments as 1st dimension.
+		:param ignored_options: Other `ViennaEnv` options like `verbose`, which are accepted so
+			the same environment options can be passed, but have no effect. A warning is shown
+			for each one that is not at its default, see `matching_options`.
+		"""
+		defaults = inspect.signature(ViennaEnv).parameters
+		for name, value in ignored_options.items():
+			if name not in defaults:
+				raise TypeError(f'Unknown environment option {name!r}.')
+			if value != defaults[name].default and value not in matching_options.get(name, ()):
+				warn(f'The native vectorized environment ignores {name}={value!r}.')
+
+		# a single environment provides the spaces & the distance matrix
+		template = ViennaEnv(
+			place_count, vehicle_count, package_count, shared_matrix=shared_matrix,
+			observation_mode=observation_mode
+		)
+
+		super().__init__(num_envs, template.observation_space, template.action_space)
+
+		self.place_count = template.place_count
+		self.vehicle_count = template.vehicle_count
+		self.package_count = template.package_count
+		self.distance_matrix = template.distance_matrix
+		self.observation_mode = observation_mode
+		self.flat_slices = flat_layout(self.vehicle_count, self.package_count)
+
+		self.clock = np.zeros(num_envs, dtype=int)
+		self.total_travel = np.zeros(num_envs, dtype=int)
+		# same as `ViennaEnv.transit_extra_total` & `ViennaEnv.undelivered_count`
+		self.transit_extra_total = np.zeros(num_envs, dtype=np.int64)
+		self.undelivered_count = np.zeros(num_envs, dtype=int)
+		# same as `ViennaEnv.ratio_ideal` & `ViennaEnv.ratio_actual`
+		self.ratio_ideal = np.zeros((num_envs, self.package_count), dtype=np.int16)
+		self.ratio_actual = np.ones((num_envs, self.package_count), dtype=np.int32)
+
+		self.environment = {
+			key: np.zeros(
+				(num_envs, self.vehicle_count if key.startswith('v_') else self.package_count),
+				dtype=dtype
+			) for key, dtype in state_dtypes.items()
+		}
+		self.environment['v_id'][:] = np.arange(self.vehicle_count)
+		self.environment['p_id'][:] = np.arange(self.package_count)
+
+		# row index used to pair every environment with its own vehicle/package columns
+		self.rows = np.arange(num_envs)[:, None]
+
+	def reset(self, *, seed: int = None, options: dict = None) -> tuple[dict, dict]:
+		"""
+		Resets every environment.
+
+		:param seed: Seeds `self.np_random`, which draws the starting positions.
+		:return: observations, info
+		"""
+		if seed is not None:
+			self._np_random, _ = seeding.np_random(seed)
+
+		self.reset_environments(np.arange(self.num_envs))
+
+		return self.get_observation(), self.get_info()
+
+	def reset_environments(self, indices: np.array):
+		"""
+		Same as `ViennaEnv.reset`, but only for the environments in `indices`.
+
+		:param indices: Indices of the environments to reset.
+		"""
+		count = len(indices)
+		if count == 0:
+			return
+
+		env = self.environment
+
+		self.clock[indices] = 0
+		self.total_travel[indices] = 0
+		self.transit_extra_total[indices] = 0
+		self.undelivered_count[indices] = self.package_count - 1
+
+		for key in ('v_transit_end', 'v_transit_remaining', 'v_has_package',
+			'p_carrying_vehicle', 'p_transit_extra'):
+			env[key][indices] = 0
+		env['v_available'][indices] = True
+		env['p_delivered'][indices] = False
+		env['p_delivered'][indices, 0] = True
+
+		# vehicles start at unique random places, vehicle 0 stays at the blank place 0
+		env['v_transit_start'][indices, 0] = 0
+		env['v_transit_start'][indices, 1:] = self.sample_places(count, self.vehicle_count - 1)
+
+		# package origins & targets are all unique places
+		locations = self.sample_places(count, 2 * (self.package_count - 1))
+		origins = locations[:, :self.package_count - 1]
+		targets = locations[:, self.package_count - 1:]
+
+		env['p_location_current'][indices, 0] = 0
+		env['p_location_current'][indices, 1:] = origins
+		env['p_location_target'][indices, 0] = 0
+		env['p_location_target'][indices, 1:] = targets
+
+		self.ratio_ideal[indices, 0] = 0
+		self.ratio_ideal[indices, 1:] = self.distance_matrix[origins, targets] + 1
+		self.ratio_actual[indices] = 1
+
+	def load_environment(self, index: int, source: ViennaEnv):
+		"""
+		Copies the state of a `ViennaEnv` of the same size into environment `index`, e.g. to
+		continue from the starting positions drawn by `ViennaEnv.reset`.
+
+		:param index: Index of the environment to overwrite.
+		:param source: Environment to copy from, it is not changed.
+		"""
+		assert (source.place_count, source.vehicle_count, source.package_count) == \
+			(self.place_count, self.vehicle_count, self.package_count), \
+			'Environment has a different size.'
+
+		for key, value in self.environment.items():
+			value[index] = source.environment[key]
+
+		self.clock[index] = source.clock
+		self.total_travel[index] = source.total_travel
+		self.transit_extra_total[index] = source.transit_extra_total
+		self.undelivered_count[index] = source.undelivered_count
+		self.ratio_ideal[index] = source.ratio_ideal
+		self.ratio_actual[index] = source.ratio_actual
+
+	def sample_places(self, count: int, amount: int) -> np.array:
+		"""
+		Vectorized version of `filler` with `random_int_up_to_fill`.
+
+		:return: Array of shape `(count, amount)`, where each row holds unique random places in
+			the range of `[1, place_count)`.
+		"""
+		keys = self.np_random.random((count, self.place_count - 1))
+		return np.argsort(keys, axis=1)[:, :amount] + 1
+
+	def step(self, actions: np.array) -> tuple[dict, np.array, np.array, np.array, dict]:
+		"""
+		Runs one timestep in every environment, see `ViennaEnv.step`. Environments that are
+		done are reset right away; their last observation & info are stored in the returned
+		info under 'final_observation' & 'final_info'.
+
+		:param actions: Array of shape `(num_envs, vehicle_count)`.
+		:return: observations, rewards, terminated, truncated, info
+		"""
+		actions = np.asarray(actions)
+		assert np.all((actions >= 0) & (actions < self.place_count))
+
+		env = self.environment
+		self.clock += 1
+
+		available = env['v_available'][:, 1:]
+		transit_start = env['v_transit_start'][:, 1:]
+		transit_end = env['v_transit_end'][:, 1:]
+		transit_remaining = env['v_transit_remaining'][:, 1:]
+
+		stopped = transit_remaining == 0
+		# dispatch to location 0 means no dispatch
+		dispatched = stopped & available & (actions != 0)
+		arrived = stopped & ~available
+
+		available[dispatched] = False
+		transit_end[dispatched] = actions[dispatched]
+		transit_remaining[dispatched] = \
+			self.distance_matrix[transit_start[dispatched], actions[dispatched]]
+
+		transit_start[arrived] = transit_end[arrived]
+		available[arrived] = True
+
+		# progress each vehicle
+		moving = env['v_transit_remaining'] > 0
+		env['v_transit_remaining'][moving] -= 1
+		self.total_travel += moving.sum(axis=1)
+
+		rewards = self.automate_packages()
+		terminated = self.undelivered_count == 0
+		truncated = np.zeros(self.num_envs, dtype=bool)
+
+		observations = self.get_observation()
+		info = self.get_info()
+
+		done = np.flatnonzero(terminated)
+		if len(done):
+			info['final_observation'] = np.full(self.num_envs, None, dtype=object)
+			info['final_info'] = np.full(self.num_envs, None, dtype=object)
+			for index in done:
+				if self.observation_mode == 'flat':
+					info['final_observation'][index] = observations[index].copy()
+				else:
+					info['final_observation'][index] = {
+						key: value[index].copy() for key, value in observations.items()
+					}
+				info['final_info'][index] = {
+					'time': info['time'][index], 'total_travel': info['total_travel'][index]
+				}
+			info['_final_observation'] = info['_final_info'] = terminated.copy()
+
+			self.reset_environments(done)
+			reset_observations = self.get_observation()
+			if self.observation_mode == 'flat':
+				observations[done] = reset_observations[done]
+			else:
+				for key in observations:
+					observations[key][done] = reset_observations[key][done]
+
+		return observations, rewards, terminated, truncated, info
+
+	def automate_packages(self) -> np.array:
+		"""
+		Pickups & deliveries of `kernels.tick_kernel`, for all environments at once.
+
+		:return: Reward of every environment.
+		"""
+		env = self.environment
+		rows = self.rows
+		carrying_vehicle = env['p_carrying_vehicle']
+
+		# state at the start of the call, every phase below only works on these packages
+		undelivered = ~env['p_delivered']
+		carried = undelivered & (carrying_vehicle != 0)
+		waiting = undelivered & (carrying_vehicle == 0)
+		empty = env['v_has_package'] == 0
+
+		# if a package is on a vehicle, make sure its location is up to date
+		updated_location = env['v_transit_start'][rows, carrying_vehicle]
+		moved = carried & (env['p_location_current'] != updated_location)
+		env['p_location_current'][moved] = updated_location[moved]
+
+		# update the total travel time of a package
+		self.ratio_actual[moved] += 1
+
+		# if a package is not delivered but on a vehicle, check if it has been delivered
+		delivered = carried & (
+			(env['v_transit_end'][rows, carrying_vehicle] == env['p_location_target']) &
+			(env['v_transit_remaining'][rows, carrying_vehicle] == 0)
+		)
+		delivered_env, delivered_package = np.nonzero(delivered)
+		freed = carrying_vehicle[delivered_env, delivered_package]
+
+		env['v_has_package'][delivered_env, freed] = 0
+		env['p_location_current'][delivered] = env['p_location_target'][delivered]
+		carrying_vehicle[delivered] = 0
+		env['p_delivered'][delivered] = True
+		env['p_transit_extra'][delivered] = \
+			self.ratio_ideal[delivered] / self.ratio_actual[delivered]
+		np.add.at(
+			self.transit_extra_total,
+			delivered_env,
+			env['p_transit_extra'][delivered_env, delivered_package]
+		)
+		self.undelivered_count -= np.bincount(delivered_env, minlength=self.num_envs)
+
+		# pickups follow the same order as in `kernels.tick_kernel`
+		pickup_after = np.full((self.num_envs, self.vehicle_count), -1)
+		pickup_after[empty] = 0
+		pickup_after[delivered_env, freed] = delivered_package
+		pickup_after[:, 0] = -1  # vehicle 0 is only padding
+		pickup_after[env['v_transit_remaining'] != 0] = -1  # vehicle is moving
+
+		matches = (
+			waiting[:, None, :] &
+			(env['v_transit_end'][:, :, None] == env['p_location_current'][:, None, :]) &
+			(pickup_after[:, :, None] >= 0) &
+			(pickup_after[:, :, None] < np.arange(self.package_count)[None, None, :])
+		)
+		pickup_env, pickup_vehicle = np.nonzero(matches.any(axis=2))
+		pickup_package = matches[pickup_env, pickup_vehicle].argmax(axis=1)
+
+		env['v_has_package'][pickup_env, pickup_vehicle] = pickup_package
+		np.maximum.at(
+			carrying_vehicle,
+			(pickup_env, pickup_package),
+			pickup_vehicle.astype(carrying_vehicle.dtype)
+		)
+
+		return self.transit_extra_total.copy()
+
+	def action_masks(self) -> np.array:
+		"""
+		Same as `ViennaEnv.action_masks` for every environment.
+
+		:return: Boolean array of shape `(num_envs, (vehicle_count-1) * place_count)`.
+		"""
+		env = self.environment
+		vehicles = np.arange(1, self.vehicle_count)
+		masks = np.zeros((self.num_envs, self.vehicle_count - 1, self.place_count), dtype=bool)
+
+		dispatchable = env['v_available'][:, 1:] & (env['v_transit_remaining'][:, 1:] == 0)
+		packages = env['v_has_package'][:, 1:]
+
+		# places of the packages waiting to be picked up in each environment
+		waiting_env, waiting_package = np.nonzero(
+			~env['p_delivered'] & (env['p_carrying_vehicle'] == 0)
+		)
+		waiting_places = np.zeros((self.num_envs, self.place_count), dtype=bool)
+		waiting_places[
+			waiting_env, env['p_location_current'][waiting_env, waiting_package]
+		] = True
+		masks |= (dispatchable & (packages == 0))[:, :, None] & waiting_places[:, None, :]
+
+		own = (
+			dispatchable & (packages != 0) &
+			(env['p_carrying_vehicle'][self.rows, packages] == vehicles) &
+			~env['p_delivered'][self.rows, packages]
+		)
+		own_env, own_vehicle = np.nonzero(own)
+		masks[
+			own_env, own_vehicle,
+			env['p_location_target'][own_env, packages[own_env, own_vehicle]]
+		] = True
+
+		arrived_env, arrived_vehicle = np.nonzero(
+			env['v_transit_end'][:, 1:] == env['v_transit_start'][:, 1:]
+		)
+		masks[
+			arrived_env, arrived_vehicle,
+			env['v_transit_start'][arrived_env, arrived_vehicle + 1]
+		] = False
+		masks[:, :, 0] = True
+
+		return masks.reshape(self.num_envs, -1)
+
+	def get_observation(self) -> dict[str, np.array] | np.ndarray:
+		"""
+		:return: Copy of the batched environment dictionary, or the batched flat or graph
+			observation.
+		"""
+		if self.observation_mode == 'flat':
+			observations = np.empty(
+				(self.num_envs, *self.single_observation_space.shape), dtype=np.int16
+			)
+			for key, columns in self.flat_slices.items():
+				observations[:, columns] = self.environment[key][:, 1:]
+			return observations
+
+		if self.observation_mode == 'graph':
+			observations = {
+				key: np.empty((self.num_envs, *space.shape), dtype=space.dtype)
+				for key, space in self.single_observation_space.items()
+			}
+			fill_graph_observation(self.environment, **observations)
+			return observations
+
+		return {key: value.copy() for key, value in self.environment.items()}
+
+	def get_info(self) -> dict[str, np.array]:
+		"""
+		:return: Batched version of the clock & total travel time in the info of `ViennaEnv`.
+		"""
+		every = np.ones(self.num_envs, dtype=bool)
+		return {
+			'time': self.clock.copy(), '_time': every,
+			'total_travel': self.total_travel.copy(), '_total_travel': every.copy(),
+		}
+
+
+class ViennaVecEnv(VecEnv):
+	def __init__(self, num_envs: int = 10, **environment_options):
+		"""
+		Stable Baselines 3 adapter for `VectorViennaEnv`, this can be passed to `PPO` in place of
+		`make_vec_env(ViennaEnv, ...)`. Episode returns & lengths are added to the info of
+		finished environments the same way `Monitor` does, so the training logs stay the same.
+
+		:param num_envs: Number of environments to simulate.
+		:param environment_options: Keyword arguments of `ViennaEnv`.
+		"""
+		self.venv = VectorViennaEnv(num_envs, **environment_options)
+		self.actions = None
+
+		self.episode_returns = np.zeros(num_envs)
+		self.episode_lengths = np.zeros(num_envs, dtype=int)
+		self.episode_starts = np.full(num_envs, time.time())
+
+		super().__init__(
+			num_envs, self.venv.single_observation_space, self.venv.single_action_space
+		)
+
+	def reset(self) -> dict[str, np.array]:
+		observations, _ = self.venv.reset(seed=self._seeds[0])
+		self._reset_seeds()
+
+		self.episode_returns[:] = 0
+		self.episode_lengths[:] = 0
+		self.episode_starts[:] = time.time()
+
+		return observations
+
+	def step_async(self, actions: np.array):
+		self.actions = actions
+
+	def step_wait(self) -> tuple[dict, np.array, np.array, list[dict]]:
+		observations, rewards, terminated, truncated, info = self.venv.step(self.actions)
+		dones = terminated | truncated
+
+		self.episode_returns += rewards
+		self.episode_lengths += 1
+
+		infos = [
+			{'time': time_single, 'total_travel': travel_single}
+			for time_single, travel_single in zip(info['time'], info['total_travel'])
+		]
+
+		now = time.time()
+		for index in np.flatnonzero(dones):
+			infos[index] = dict(info['final_info'][index])
+			infos[index]['terminal_observation'] = info['final_observation'][index]
+			infos[index]['TimeLimit.truncated'] = bool(truncated[index] and not terminated[index])
+			infos[index]['episode'] = {
+				'r': float(self.episode_returns[index]),
+				'l': int(self.episode_lengths[index]),
+				't': round(now - self.episode_starts[index], 6),
+			}
+			self.episode_returns[index] = 0
+			self.episode_lengths[index] = 0
+			self.episode_starts[index] = now
+
+		return observations, rewards.astype(np.float32), dones, infos
+
+	def close(self):
+		self.venv.close()
+
+	def get_attr(self, attr_name: str, indices: Iterable[int] = None) -> list[Any]:
+		return [getattr(self.venv, attr_name)] * len(self._indices(indices))
+
+	def set_attr(self, attr_name: str, value: Any, indices: Iterable[int] = None):
+		setattr(self.venv, attr_name, value)
+
+	def env_method(self,
+		method_name: str, *method_args, indices: Iterable[int] = None, **method_kwargs
+	) -> list[Any]:
+		if method_name == 'action_masks':
+			# computed for every environment at once, `MaskablePPO` expects one row per environment
+			return list(self.venv.action_masks()[self._indices(indices)])
+
+		method = getattr(self.venv, method_name)
+		return [method(*method_args, **method_kwargs)] * len(self._indices(indices))
+
+	def env_is_wrapped(self,
+		wrapper_class: type[gym.Wrapper], indices: Iterable[int] = None
+	) -> list[bool]:
+		return [False] * len(self._indices(indices))
+
+	def _indices(self, indices: Iterable[int] = None) -> list[int]:
+		if indices is None:
+			return list(range(self.num_envs))
+		if isinstance(indices, int):
+			return [indices]
+		return list(indices)
@@ -1,17 +1,74 @@
 # https://stable-baselines3.readthedocs.io/en/master/guide/custom_env.html
 import random
-from typing import Any
+from typing import Any, Callable, Iterator, NamedTuple
+from collections.abc import Mapping, MutableMapping
 import gymnasium as gym
 from gymnasium.spaces import MultiDiscrete, Dict, MultiBinary, Box
-from distances import create_distance_matrix
+from distances import get_distance_matrix, attach_distance_matrix, SharedMatrixInfo
+from recorder import TraceRecorder, DISPATCH, ARRIVAL, PICKUP, DELIVERY
+from kernels import load_compiled_tick, tick_kernel, event_capacity
+from warnings import warn
 import numpy as np
 import time
 
 
+# types of the fields in the environment dictionary. Places, vehicle ids & package ids never
+# exceed 81, so they fit into a single byte. `p_transit_extra` stays an integer, since the
+# delivered ratios have always been truncated when written into it.
+state_dtypes = {
+	'v_id': np.uint8,
+	'v_available': bool,
+	'v_transit_start': np.uint8,
+	'v_transit_end': np.uint8,
+	'v_transit_remaining': np.int16,
+	'v_has_package': np.uint8,
+
+	'p_id': np.uint8,
+	'p_location_current': np.uint8,
+	'p_location_target': np.uint8,
+	'p_carrying_vehicle': np.uint8,
+	'p_delivered': bool,
+	'p_transit_extra': np.int16,
+}
+
+# fields of the flat observation in the order they are laid out, see `flat_layout`. The ids
+# are left out as they never change.
+flat_fields = (
+	'v_available', 'v_transit_start', 'v_transit_end', 'v_transit_remaining', 'v_has_package',
+	'p_location_current', 'p_location_target', 'p_carrying_vehicle', 'p_delivered',
+	'p_transit_extra',
+)
+
+# parts of `step` timed when profiling is enabled, see `ViennaEnv.stats`. 'kernel' covers the
+# dispatch, the progression & the pickups & deliveries of `tick`.
+profile_phases = ('validation', 'kernel', 'reward', 'observation', 'info')
+
+# features of every place & vehicle in the graph observation, see `fill_graph_observation`
+place_features = ('waiting', 'destined', 'vehicles_stopped', 'vehicles_heading')
+vehicle_features = ('position', 'dispatchable', 'transit_remaining', 'package_target')
+
+
+class EnvState(NamedTuple):
+	"""
+	Snapshot of a `ViennaEnv` returned by `ViennaEnv.get_state`. Every array of the environment
+	is packed into the single byte buffer `arrays`, the rest are the scalars of the simulation. `ViennaEnv.set_state` only reads from a snapshot, so the same snapshot can be
+	restored any number of times.
+	"""
+	arrays: np.array
+	clock: int
+	total_travel: int
+	last_package_event: int
+	transit_extra_total: np.int64
+	undelivered_count: int
+
+
 class ViennaEnv(gym.Env):
 	def __init__(self,
 		place_count: int = 80, vehicle_count: int = 10, package_count: int = 20,
-		verbose: bool = False, verbose_trigger: int = 100_000
+		verbose: bool = False, verbose_trigger: int = 100_000,
+		shared_matrix: SharedMatrixInfo = None, skip_idle_time: bool = False,
+		info_level: str = 'full', recorder: TraceRecorder = None,
+		observation_mode: str = 'dict', backend: str = 'numpy', profile: bool = False
 	):
 		"""
 		Custom Environment that follows gym interface. This Viena Environment creates a space
@@ -21,8 +78,39 @@ class ViennaEnv(gym.Env):
 		
 		:param place_count: Number of places to use, out of the 80 total. Details about these
 			places can be found in `data/places/places.csv`.
+		:param shared_matrix: Info returned by `distances.share_distance_matrix` in the parent
+			process. When given, the distance matrix is attached from shared memory instead of
+			being loaded by this environment, which keeps subprocess workers from each holding
+			their own copy.
+		:param skip_idle_time: When enabled, `step` does not return while every vehicle is still
+			on its way, but keeps advancing the clock until a vehicle is available for a new
+			dispatch, a package has been picked up or delivered, or the episode is over. The
+			rewards of the skipped timesteps are added up, so the clock & total travel time
+			are the same as when stepping through every timestep with no dispatch.
+		:param info_level: How much `get_info` returns after every step. 'none' returns an empty
+			dictionary, 'minimal' only the clock & total travel time, & 'full' everything needed
+			by the visualizer, where the package scores are only computed once they are read.
+		:param recorder: Once the clock exceeds `verbose_trigger`, dispatches, arrivals, pickups
+			& deliveries are recorded into this instead of enabling verbose printing, which
+			would slow the training down to a crawl. Several environments can share one recorder.
+		:param observation_mode: 'dict' returns `self.environment` as observation, which SB3's
+			`MultiInputPolicy` one-hot encodes. 'flat' returns all fields except the ids in a
+			single integer array, see `flat_layout`, meant for `extractors.EmbeddingExtractor`.
+			'graph' returns features of every place & vehicle, see `fill_graph_observation`,
+			meant for `extractors.GraphExtractor`, which connects the places through their
+			nearest neighbours.
+		:param backend: 'numpy' runs each timestep as plain loops over the environment arrays
+			(`kernels.tick_kernel`), which is cheaper than vectorized numpy calls for every fleet
+			that fits on the places. 'numba' compiles the same function, which is faster still.
+			Falls back to 'numpy' with a warning if numba is not installed.
+		:param profile: Adds up the time spent in each phase of `step`, see `stats`. Can also be
+			switched at any time with `self.profiling`. When disabled, each phase only costs a
+			single check.
 		"""
 		assert 1 <= place_count <= 80, print('only 80 places available')
+		assert info_level in ('none', 'minimal', 'full'), 'Invalid info level'
+		assert observation_mode in ('dict', 'flat', 'graph'), 'Invalid observation mode'
+		assert backend in ('numpy', 'numba'), 'Invalid backend'
 
 		super().__init__()
 
@@ -30,22 +118,79 @@ class ViennaEnv(gym.Env):
 		self.vehicle_count = vehicle_count + 1
 		self.package_count = package_count + 1
 
-		self.distance_matrix = create_distance_matrix(place_count)
+		if shared_matrix is None:
+			self.distance_matrix = get_distance_matrix(place_count)
+		else:
+			assert shared_matrix.shape == (self.place_count, self.place_count), \
+				'Shared distance matrix does not match the place count.'
+			self.distance_matrix = attach_distance_matrix(shared_matrix)
 		self.verbose = verbose
 		self.verbose_trigger = verbose_trigger
+		self.skip_idle_time = skip_idle_time
+		# draws the starting positions, seeded by `reset`
+		self.random = random.Random()
+		self.info_level = info_level
+		self.observation_mode = observation_mode
+
+		# numba is only imported when it is used
+		self.kernel = load_compiled_tick() if backend == 'numba' else tick_kernel
+		if self.kernel is None:
+			warn('numba is not installed, falling back to the numpy backend.')
+			backend = 'numpy'
+			self.kernel = tick_kernel
+		self.backend = backend
+
+		self.profiling = profile
+		self.phase_times = dict.fromkeys(profile_phases, 0.)
+		self.phase_calls = dict.fromkeys(profile_phases, 0)
+		self.recorder = recorder
+		self.recorder_id = 0 if recorder is None else recorder.register()
+		self.tracing = False  # whether events are currently recorded
+		# events of the latest timestep reported by the kernel, see `report_events`. The kernel
+		# gets the empty array while nothing is printed or recorded.
+		self.events = np.zeros((event_capacity(self.vehicle_count, self.package_count), 4), int)
+		self.no_events = np.zeros((0, 4), int)
 		
 		self.clock = 0  # total time the episode has been running
+		self.last_package_event = 0  # clock of the latest pickup or delivery
 		self.total_travel = 0  # sum of all distance traveled by all vehicles
-		self.package_origins = []
-		self.package_ratios = [  # to update `self.observation_space['p_transit_extra']
-			{
-				'ideal': 0,  # holds the minimum required distance to deliver a package
-				'actual': 1  # total distance each package has traveled on a vehicle,
-				# padded by 1 to avoid division by 0
-			} for _ in range(self.package_count)
+		# running totals of `p_transit_extra` & the undelivered packages, which only change on
+		# deliveries, so that the reward & termination do not need to look at every package
+		self.transit_extra_total = np.int64(0)
+		self.undelivered_count = self.package_count - 1
+		self.package_origins = np.zeros(self.package_count - 1, dtype=np.uint8)
+		# to update `self.observation_space['p_transit_extra']`
+		# holds the minimum required distance to deliver a package
+		self.ratio_ideal = np.zeros(self.package_count, dtype=np.int16)
+		# total distance each package has traveled on a vehicle, padded by 1 to avoid division
+		# by 0
+		self.ratio_actual = np.ones(self.package_count, dtype=np.int32)
+		# id of the package waiting to be picked up at every place, 0 if none, kept up to date
+		# by the kernel. Origins are distinct, so no place ever has more than one.
+		self.waiting_at = np.zeros(self.place_count, dtype=np.uint8)
+		# vehicles that stopped during a timestep, filled by the kernel
+		self.stopped = np.zeros(self.vehicle_count, dtype=np.uint8)
+
+		# every array is allocated once here & refilled in place by `reset`, thus observations
+		# returned by `reset` & `step` are views that change with the environment
+		self.environment = {
+			key: np.zeros(
+				self.vehicle_count if key.startswith('v_') else self.package_count,
+				dtype=dtype
+			) for key, dtype in state_dtypes.items()
+		}
+		self.environment['v_id'][:] = np.arange(self.vehicle_count)
+		self.environment['p_id'][:] = np.arange(self.package_count)
+
+		# byte views of every array that makes up the state, packed one after another by
+		# `get_state`. The arrays are never replaced, so the views stay valid.
+		self.state_views = [
+			array.view(np.uint8) for array in (
+				*self.environment.values(),
+				self.package_origins, self.ratio_ideal, self.ratio_actual, self.waiting_at
+			)
 		]
-		
-		self.environment = {}
+		self.state_offsets = np.cumsum([0] + [len(view) for view in self.state_views]).tolist()
 		
 		self.observation_space = Dict({
 			# # information of all location distances, regardless of how many locations end up
@@ -112,6 +257,45 @@ class ViennaEnv(gym.Env):
 			is later used as a multiplier for the reward function.
 		'''
 
+		if observation_mode == 'flat':
+			self.flat_slices = flat_layout(self.vehicle_count, self.package_count)
+			# refilled in place by `get_observation`, like the arrays of `self.environment`
+			self.flat_observation = np.zeros(
+				self.flat_slices['p_transit_extra'].stop, dtype=np.int16
+			)
+			highest = {
+				'v_available': 1,
+				'v_transit_start': self.place_count - 1,
+				'v_transit_end': self.place_count - 1,
+				'v_transit_remaining': np.amax(self.distance_matrix),
+				'v_has_package': self.package_count - 1,
+				'p_location_current': self.place_count - 1,
+				'p_location_target': self.place_count - 1,
+				'p_carrying_vehicle': self.vehicle_count - 1,
+				'p_delivered': 1,
+				# the ideal distance + 1 divided by at least 1
+				'p_transit_extra': np.amax(self.distance_matrix) + 1,
+			}
+			high = np.zeros_like(self.flat_observation)
+			for key, columns in self.flat_slices.items():
+				high[columns] = highest[key]
+			self.observation_space = Box(low=0, high=high, dtype=np.int16)
+
+		elif observation_mode == 'graph':
+			# `fill_graph_observation` works on batches, so the arrays have a batch of 1 in front
+			self.batched_environment = {
+				key: value[None] for key, value in self.environment.items()
+			}
+			self.batched_graph = {
+				'places': np.zeros((1, self.place_count - 1, len(place_features)), np.int16),
+				'vehicles': np.zeros((1, self.vehicle_count - 1, len(vehicle_features)), np.int16),
+			}
+			self.graph_observation = {key: value[0] for key, value in self.batched_graph.items()}
+			self.observation_space = graph_observation_space(
+				self.place_count, self.vehicle_count, self.package_count,
+				np.amax(self.distance_matrix)
+			)
+
 		# possible values are in the range of the number of locations
 		self.action_space = MultiDiscrete(vehicle_count * [self.place_count])
 	
@@ -123,88 +307,78 @@ class ViennaEnv(gym.Env):
 		Sets the environment back to its original state. The environment object is
 		re-initialized with random vehicle & package positions to be delivered.
 		
-		:param seed: Alters `np_random_seed`.
+		:param seed: Seeds `self.random`, which draws the starting positions, & `np_random`. The
+			same seed always gives the same episode, later resets without a seed continue from
+			the seeded state.
 		:param verbose: Overrides the class attribute `self.verbose`. The method in verbose mode
 			will print out package location data.
 		:return: environment, info
 		"""
 		super().reset(seed=seed)
+		if seed is not None:
+			self.random.seed(seed)
 		
 		verbose_internal = self.verbose if verbose is None else verbose
 
 		self.clock = 0  # total time the episode has been running
+		self.last_package_event = 0
 		self.total_travel = 0  # sum of all distance traveled by all vehicles
-		self.package_origins = []
-		self.package_ratios = [  # to update `self.observation_space['p_transit_extra']
-			{
-				'ideal': 0,  # holds the minimum required distance to deliver a package
-				'actual': 1  # total distance each package has traveled on a vehicle,
-				# padded by 1 to avoid division by 0
-			} for _ in range(self.package_count)
-		]
-		
-		environment_object = {
-			#'distances': self.distance_matrix,
-			
-			'v_id': np.array(range(self.vehicle_count)),
-			'v_available': filler(self.vehicle_count, True),
-			'v_transit_start': filler(
-				self.vehicle_count, self.place_count, True, True
-			),
-			'v_transit_end': filler(self.vehicle_count),
-			'v_transit_remaining': filler(self.vehicle_count, ),
-			'v_has_package': filler(self.vehicle_count),
-			
-			'p_id': np.array(range(self.package_count)),
-			# 'p_location_current': filler(
-			# 	self.package_count, self.place_count, True, True
-			# ),
-			'p_location_current': [0],
-			'p_location_target': [0],
-			'p_carrying_vehicle': filler(self.package_count),
-			'p_delivered': filler(self.package_count, False),
-			'p_transit_extra': filler(self.package_count,)
-		}
-		
-		if verbose_internal:
-			print(
-				f'reset(), package locations{"-"*32}'
-				f'\n\tcurr: {environment_object["p_location_current"]}'
-				f'\n\ttarg: {environment_object["p_location_target"]}'
-			)
-		
+		self.transit_extra_total = np.int64(0)
+		self.undelivered_count = self.package_count - 1
+		self.ratio_actual[:] = 1
+
+		environment = self.environment
+		environment['v_available'][:] = True
+		environment['v_transit_start'][:] = filler(
+			self.vehicle_count, self.place_count, True, True, self.random
+		)
+		for key in (
+			'v_transit_end', 'v_transit_remaining', 'v_has_package',
+			'p_carrying_vehicle', 'p_delivered', 'p_transit_extra'
+		):
+			environment[key][:] = 0
+
 		# fill origin & target destinations with random unique values
 		locations = filler(
 			self.package_count * 2 - 2,
 			self.place_count,
-			random_int_up_to_fill=True
+			random_int_up_to_fill=True,
+			generator=self.random
 		)
-		
-		# populate package origins & targets
-		for p in range(1, self.package_count):
-			environment_object['p_location_current'].append(locations[p-1])
-			self.package_origins.append(locations[p-1])
+		origins, targets = locations[:self.package_count-1], locations[self.package_count-1:]
+
+		# populate package origins & targets, package 0 stays at the blank place 0
+		self.package_origins[:] = origins
+		environment['p_location_current'][0] = environment['p_location_target'][0] = 0
+		environment['p_location_current'][1:] = origins
+		environment['p_location_target'][1:] = targets
 
-			environment_object['p_location_target'].append(locations[p-2+self.package_count])
+		# assign the ideal package distances
+		self.ratio_ideal[0] = 0
+		self.ratio_ideal[1:] = self.distance_matrix[origins, targets] + 1
 
-			# assign the ideal package distances
-			self.package_ratios[p]['ideal'] = \
-				self.distance_matrix[locations[p-1]][locations[p-2+self.package_count]] + 1
-			if verbose_internal:
+		if verbose_internal:
+			print(
+				f'reset(), package locations{"-"*32}'
+				f'\n\tcurr: {environment["p_location_current"]}'
+				f'\n\ttarg: {environment["p_location_target"]}'
+			)
+			for p in range(1, self.package_count):
 				print(
 					f'* for package {p}:'
-					f'from {locations[p-1]} to {locations[p-2+self.package_count]}, '
-					f'got value {self.distance_matrix[locations[p-1]][locations[p-2+self.package_count]] + 1}'
+					f'from {origins[p-1]} to {targets[p-1]}, '
+					f'got value {self.ratio_ideal[p]}'
 				)
-		
+
 		# set the delivered status of package 0 to true, so that the simulation can still detect
 		# when all packages are delivered
-		environment_object['p_delivered'][0] = True
-		
-		self.environment = environment_object
+		environment['p_delivered'][0] = True
+
+		self.waiting_at[:] = 0
+		self.waiting_at[origins] = np.arange(1, self.package_count)
 		
 		return (
-			environment_object,
+			self.get_observation(),
 			{
 				'clock': self.clock,
 				'total_travel': self.total_travel
@@ -223,12 +397,20 @@ class ViennaEnv(gym.Env):
 		:return: observation, reward, terminated, truncated, info
 		"""
 
-		if not self.verbose and self.clock > self.verbose_trigger:
-			self.verbose = True
-			print(
-				f'Clock ({self.clock} has exceeded limit {self.verbose_trigger} '
-				f'set by verbose trigger. Verbosity is now enabled'
-			)
+		if not (self.verbose or self.tracing) and self.clock > self.verbose_trigger:
+			if self.recorder is None:
+				self.verbose = True
+				print(
+					f'Clock ({self.clock} has exceeded limit {self.verbose_trigger} '
+					f'set by verbose trigger. Verbosity is now enabled'
+				)
+			else:
+				self.tracing = True
+				print(
+					f'Clock ({self.clock} has exceeded limit {self.verbose_trigger} '
+					f'set by verbose trigger. Events are now recorded'
+					+ ('' if self.recorder.path is None else f' to {self.recorder.path}')
+				)
 
 		if self.verbose:
 			print(
@@ -236,133 +418,220 @@ class ViennaEnv(gym.Env):
 				f'\n\t{action}'
 			)
 
-		for dispatch_location in action:
-			assert dispatch_location in range(self.place_count)
+		if self.profiling: start = time.perf_counter()
+		action = np.asarray(action)
+		# a loop over the few decisions is cheaper than the numpy calls for any usual fleet
+		assert all(0 <= place < self.place_count for place in action.tolist())
+		if self.profiling: self.add_phase_time('validation', start)
 
-		self.clock += 1
+		reward = self.tick(action)
 
-		for v, vehicle_decision in enumerate(action, start=1):
-			# helper functions to shorten navigation of the object environment dictionary
-			def vehi(key): return self.environment[key][v]
-			def vehi_set(key, val): self.environment[key][v] = val
-
-			if vehi('v_transit_remaining') == 0:
-				'''
-				this if else block creates an intermediary pause between a vehicle reaching its
-				destination & being dispatched to the next location, allowing
-				`self.automate_packages()` enough time to make any vehicle deliver/pickup any
-				packages before the vehicle leaves
-				'''
-				if vehi('v_available'):
-					# dispatch to location 0 means no dispatch
-					if vehicle_decision != 0:
-						vehi_set('v_available', False)
-						vehi_set('v_transit_end', vehicle_decision)
-						vehi_set(
-							'v_transit_remaining',
-							self.distance_matrix[vehi('v_transit_start')][vehicle_decision]
-						)
-				else:
-					vehi_set('v_transit_start', vehi('v_transit_end'))
-					vehi_set('v_available', True)
-
-		# progress each vehicle
-		for v in range(self.vehicle_count):
-			if self.environment['v_transit_remaining'][v] > 0:
-				self.environment['v_transit_remaining'][v] -= 1
-				self.total_travel += 1
+		if self.skip_idle_time:
+			reward += self.skip_idle_ticks()
 
-		return (
-			self.environment,
-			self.automate_packages(),
-			all(self.environment['p_delivered']),
-			False,
-			self.get_info()
+		# the reward itself is a running total kept up to date by `tick`
+		if self.profiling: start = time.perf_counter()
+		terminated = self.undelivered_count == 0
+		if self.profiling: start = self.add_phase_time('reward', start)
+		observation = self.get_observation()
+		if self.profiling: start = self.add_phase_time('observation', start)
+		info = self.get_info()
+		if self.profiling: self.add_phase_time('info', start)
+
+		if terminated:
+			# vectorized environments reset right away, which refills the arrays returned here
+			observation, info = copy_arrays(observation), copy_arrays(info)
+
+		return observation, reward, terminated, False, info
+
+	def close(self):
+		"""
+		Writes the remaining events of the recorder, which matters in worker processes that
+		hold their own copy of it.
+		"""
+		if self.recorder is not None:
+			self.recorder.close()
+		super().close()
+
+	def tick(self, action: np.array):
+		"""
+		Advances the clock by one timestep, see `step`. The vehicles are dispatched & progressed
+		& the packages picked up & delivered by `self.kernel`, which may be compiled by numba.
+		While printing verbosely or recording, the kernel also reports every event.
+
+		:param action: Validated dispatch decisions.
+		:return: Reward of this timestep.
+		"""
+		if self.profiling: start = time.perf_counter()
+		self.clock += 1
+
+		env = self.environment
+		reporting = self.verbose or self.tracing
+		moved, delivered, transit_extra, picked_up, event_count = self.kernel(
+			action, self.distance_matrix,
+			env['v_available'], env['v_transit_start'], env['v_transit_end'],
+			env['v_transit_remaining'], env['v_has_package'],
+			env['p_location_current'], env['p_location_target'], env['p_carrying_vehicle'],
+			env['p_delivered'], env['p_transit_extra'],
+			self.ratio_ideal, self.ratio_actual, self.waiting_at, self.stopped,
+			self.events if reporting else self.no_events
 		)
 
-	def automate_packages(self):
+		self.total_travel += moved
+		if delivered:
+			self.transit_extra_total += transit_extra
+			self.undelivered_count -= delivered
+			self.last_package_event = self.clock
+		if picked_up:
+			self.last_package_event = self.clock
+		if reporting:
+			self.report_events(self.events[:event_count])
+		if self.profiling: self.add_phase_time('kernel', start)
+
+		return self.transit_extra_total
+
+	def report_events(self, events: np.array):
 		"""
-		Automatically pick up / drop off packages when a vehicle passes over the correct
-		location.
-		
-		:return: # of packages that have been delivered multiplied by their extra transit ratio
-			for the reward function.
+		Records the events of a timestep & prints the pickups & deliveries when verbose.
+
+		:param events: Rows of kind, vehicle, package & place written by `kernels.tick_kernel`.
 		"""
-		
+		if self.tracing and len(events):
+			self.recorder.record(
+				events[:, 0], self.clock, self.recorder_id, events[:, 1], events[:, 2], events[:, 3]
+			)
+
 		if self.verbose:
 			print(
 				f'\nautomate_packages(){"-"*32}'
 			)
+			for kind, v, p, _ in events.tolist():
+				if kind == DELIVERY:
+					print(f'*package {p} delivered by vehicle {v}')
+				elif kind == PICKUP:
+					print(
+						f'automate_packages(), pickup detected'
+						f'package {p} picked up by vehicle {v}'
+					)
 
-		for p in range(1, self.package_count):
+	def add_phase_time(self, phase: str, start: float) -> float:
+		"""
+		Adds the time since `start` to a phase of `profile_phases`.
 
-			# helper functions to shorten navigation of the object environment dictionary
-			def pack(key): return self.environment[key][p]
-			def pack_set(key, val): self.environment[key][p] = val
+		:return: Current time, to use as start of the next phase.
+		"""
+		now = time.perf_counter()
+		self.phase_times[phase] += now - start
+		self.phase_calls[phase] += 1
+		return now
 
-			# if a package is already delivered, there are no operations to be done
-			if pack('p_delivered'): continue
+	def stats(self) -> dict[str, dict[str, float]]:
+		"""
+		Profiling results since the environment was created or `reset_stats` was called. Phases
+		that never ran are left out.
 
-			# if a package is on a vehicle, make sure its location is up to date
-			if (
-				pack('p_carrying_vehicle') != 0 and
-				pack('p_location_current') != (updated_location :=
-					self.environment['v_transit_start'][pack('p_carrying_vehicle')]
-				)
-			):
-				pack_set('p_location_current', updated_location)
-				
-				# update the total travel time of a package
-				self.package_ratios[p]['actual'] += 1
-
-			# for any undelivered package currently not on a vehicle,
-			# make sure any empty vehicles fulfill the request
-			if pack('p_carrying_vehicle') == 0:
-				for v in range(1, self.vehicle_count):
-					def vehi(key): return self.environment[key][v]
-					def vehi_set(key, val): self.environment[key][v] = val
-
-					# if an empty vehicle passes by, pick up the package
-					if (
-						vehi('v_has_package') == 0 and
-						vehi('v_transit_end') == pack('p_location_current') and
-						vehi('v_transit_remaining') == 0  # vehicle is not moving
-					):
-						if self.verbose:
-							print(
-								f'automate_packages(), pickup detected'
-								f'package {p} picked up by vehicle {v}'
-							)
-						vehi_set('v_has_package', p)
-						pack_set('p_carrying_vehicle', v)
-
-			# if a package is not delivered but on a vehicle, check if it has been delivered
-			else:
-				# same helper functions as before, but now instead of checking every vehicle
-				# only the index of its carrying vehicle is used
-				def vehi(key):
-					return self.environment[key][pack('p_carrying_vehicle')]
-				def vehi_set(key, val):
-					self.environment[key][pack('p_carrying_vehicle')] = val
-
-				# check if package could be delivered
-				if (
-					vehi('v_transit_end') == pack('p_location_target') and
-					vehi('v_transit_remaining') == 0
-				):
-					if self.verbose:
-						print(f'*package {p} delivered by vehicle {pack("p_carrying_vehicle")}')
-					vehi_set('v_has_package', 0)
-					pack_set('p_location_current', pack('p_location_target'))
-					pack_set('p_carrying_vehicle', 0)
-					pack_set('p_delivered', True)
-					pack_set(
-						'p_transit_extra',
-						self.package_ratios[p]['ideal'] / self.package_ratios[p]['actual']
-					)
-		
-		#return sum(self.environment['p_delivered']-1)
-		return sum(self.environment['p_transit_extra'])
+		:return: Phase -> 'calls', total time in seconds as 'total_s' & the average time per call
+			in microseconds as 'mean_us'.
+		"""
+		return {
+			phase: {
+				'calls': calls,
+				'total_s': self.phase_times[phase],
+				'mean_us': self.phase_times[phase] / calls * 1e6,
+			} for phase, calls in self.phase_calls.items() if calls
+		}
+
+	def reset_stats(self):
+		"""
+		Sets every profiling total back to 0.
+		"""
+		self.phase_times = dict.fromkeys(profile_phases, 0.)
+		self.phase_calls = dict.fromkeys(profile_phases, 0)
+
+	def skip_idle_ticks(self):
+		"""
+		Runs timesteps without any dispatch until a vehicle can be dispatched, a package event
+		happened or every package is delivered, see `skip_idle_time` in `__init__`. While every
+		vehicle is moving nothing but the remaining transit times changes, so those timesteps
+		are jumped over at once up to the timestep before the next arrival.
+
+		:return: Sum of the rewards of the skipped timesteps.
+		"""
+		reward = 0
+		no_dispatch = np.zeros(self.vehicle_count - 1, dtype=int)
+		available = self.environment['v_available'][1:]
+		transit_remaining = self.environment['v_transit_remaining'][1:]
+
+		while (
+			self.vehicle_count > 1 and
+			self.last_package_event != self.clock and
+			self.undelivered_count > 0 and
+			not np.any(available & (transit_remaining == 0))
+		):
+			if np.all(transit_remaining > 0):
+				ticks = int(transit_remaining.min()) - 1
+				transit_remaining -= ticks
+				self.clock += ticks
+				self.total_travel += ticks * len(transit_remaining)
+				# the reward of a timestep only changes on deliveries
+				reward += ticks * self.transit_extra_total
+
+			reward += self.tick(no_dispatch)
+
+		return reward
+
+	def get_observation(self) -> dict[str, np.array] | np.ndarray:
+		"""
+		:return: `self.environment` in 'dict' observation mode, otherwise the flat or graph
+			observation refilled from it.
+		"""
+		if self.observation_mode == 'dict':
+			return self.environment
+
+		if self.observation_mode == 'graph':
+			fill_graph_observation(self.batched_environment, **self.batched_graph)
+			return self.graph_observation
+
+		for key, columns in self.flat_slices.items():
+			self.flat_observation[columns] = self.environment[key][1:]
+
+		return self.flat_observation
+
+	def get_state(self) -> EnvState:
+		"""
+		Captures the full simulation state, which is much cheaper than `copy.deepcopy` of the
+		environment, as the spaces & the distance matrix are left out. Useful to branch many
+		rollouts from the same timestep.
+
+		:return: Snapshot to pass to `set_state`.
+		"""
+		return EnvState(
+			np.concatenate(self.state_views),
+			self.clock,
+			self.total_travel,
+			self.last_package_event,
+			self.transit_extra_total,
+			self.undelivered_count,
+		)
+
+	def set_state(self, state: EnvState):
+		"""
+		Restores a snapshot of `get_state` taken from an environment with the same place, vehicle
+		& package count. The arrays are refilled in place, so earlier observations follow along.
+		"""
+		assert len(state.arrays) == self.state_offsets[-1], \
+			'State was taken from an environment of a different size.'
+
+		for view, start, end in zip(
+			self.state_views, self.state_offsets, self.state_offsets[1:]
+		):
+			view[:] = state.arrays[start:end]
+
+		self.clock = state.clock
+		self.total_travel = state.total_travel
+		self.last_package_event = state.last_package_event
+		self.transit_extra_total = state.transit_extra_total
+		self.undelivered_count = state.undelivered_count
 
 	def get_package_distances(self):
 		"""
@@ -388,7 +657,7 @@ class ViennaEnv(gym.Env):
 	) -> dict:
 		"""
 		:return: `self.environment` object but only keys shown in the default arguments for
-			debugging & visualization
+			debugging & visualization, depending on `self.info_level`.
 		"""
 
 		if self.verbose:
@@ -400,30 +669,76 @@ class ViennaEnv(gym.Env):
 				print(f'\t{p_info}: {self.environment[p_info]}')
 			time.sleep(.1)
 
-		info_dict = {}
+		if self.info_level == 'none':
+			return {}
+
+		if self.info_level == 'minimal':
+			return {'time': self.clock, 'total_travel': self.total_travel}
+
+		info_dict = LazyInfo()
 
 		for key in v_infos + p_infos:
 			info_dict[key] = self.environment[key]
 		
-		'''
-		At 1st every package ratio is above 1. However, this score is not relevant as the
-		package has not moved yet. Thus the score reset to zero until it gets below 1. For
-		display purposes, the score itself is multiplied by 100 & coerced to an integer.
-		'''
-		info_dict['p_ratios'] = []
-		for p, steps in enumerate(self.package_ratios):
-			
-			ratio = steps['ideal'] / steps['actual']
-			
-			if not info_dict['p_delivered'][p] and ratio >= 1:
-				info_dict['p_ratios'].append(0)
-			else:
-				info_dict['p_ratios'].append(int(ratio * 100))
-		
+		info_dict.set_lazy('p_ratios', self.get_package_scores)
+		info_dict.set_lazy('action_masks', self.action_masks)
 		info_dict['time'] = self.clock
 		info_dict['total_travel'] = self.total_travel
 		
 		return info_dict
+
+	def action_masks(self) -> np.array:
+		"""
+		Marks the places each vehicle can usefully be dispatched to, in the format expected by
+		`sb3_contrib.MaskablePPO`. Dispatching to place 0 (no dispatch) is always allowed. A
+		vehicle that is moving or has not been released after arriving ignores its dispatch, so
+		only place 0 is allowed. An empty vehicle may go to any place with packages waiting to be
+		picked up, while a vehicle carrying a package may only go to its target. The current
+		location of a vehicle is not allowed once it has arrived there. After a reset, vehicles
+		have not arrived at their starting place yet & only pick up packages there when
+		dispatched to it, which takes no time.
+
+		:return: Boolean array of shape `((vehicle_count-1) * place_count,)`, holding the mask of
+			vehicle 1 followed by the mask of vehicle 2 & so on.
+		"""
+		env = self.environment
+		masks = np.zeros((self.vehicle_count - 1, self.place_count), dtype=bool)
+
+		dispatchable = env['v_available'][1:] & (env['v_transit_remaining'][1:] == 0)
+		packages = env['v_has_package'][1:]
+
+		empty = np.flatnonzero(dispatchable & (packages == 0))
+		waiting = np.flatnonzero(self.waiting_at)
+		if len(empty) and len(waiting):
+			masks[np.ix_(empty, waiting)] = True
+
+		# vehicles that still hold a package they no longer carry cannot do anything
+		carrying = np.flatnonzero(dispatchable & (packages != 0))
+		carried = packages[carrying]
+		own = (
+			(env['p_carrying_vehicle'][carried] == carrying + 1) &
+			~env['p_delivered'][carried]
+		)
+		masks[carrying[own], env['p_location_target'][carried[own]]] = True
+
+		arrived = np.flatnonzero(env['v_transit_end'][1:] == env['v_transit_start'][1:])
+		masks[arrived, env['v_transit_start'][1:][arrived]] = False
+		masks[:, 0] = True
+
+		return masks.reshape(-1)
+
+	def get_package_scores(self) -> list[int]:
+		"""
+		At 1st every package ratio is above 1. However, this score is not relevant as the
+		package has not moved yet. Thus the score reset to zero until it gets below 1. For
+		display purposes, the score itself is multiplied by 100 & coerced to an integer.
+
+		:return: Score of every package, shown by the visualizer.
+		"""
+		ratios = self.ratio_ideal / self.ratio_actual
+		return np.where(
+			~self.environment['p_delivered'] & (ratios >= 1), 0, (ratios * 100).astype(int)
+		).tolist()
 	
 	def multi_disc(self, mode: str, value_range: int) -> MultiDiscrete:
 		"""
@@ -448,9 +763,164 @@ class ViennaEnv(gym.Env):
 		return MultiDiscrete(filler(amount, value_range))
 
 
+def copy_arrays(values: Mapping[str, Any] | np.ndarray) -> dict[str, Any] | np.ndarray:
+	"""
+	:return: Copy of an array or of a mapping with its arrays copied, lazy values are computed.
+	"""
+	if isinstance(values, np.ndarray):
+		return values.copy()
+	return {
+		key: value.copy() if isinstance(value, np.ndarray) else value
+		for key, value in values.items()
+	}
+
+
+class LazyInfo(MutableMapping):
+	"""
+	Dictionary for the info returned by `ViennaEnv.get_info`, where some values are only
+	computed the 1st time they are read. Keys keep their insertion order like a normal `dict`, so
+	iterating over the items computes every lazy value. Pickling (e.g. to send the info from a
+	subprocess environment) turns it into a normal `dict`.
+	"""
+	def __init__(self):
+		self.values: dict[str, Any] = {}
+		self.lazy: dict[str, Callable[[], Any]] = {}
+
+	def set_lazy(self, key: str, compute: Callable[[], Any]):
+		"""
+		:param compute: Called without arguments the 1st time `key` is read.
+		"""
+		self.values[key] = None
+		self.lazy[key] = compute
+
+	def __getitem__(self, key: str) -> Any:
+		if key in self.lazy:
+			self.values[key] = self.lazy.pop(key)()
+		return self.values[key]
+
+	def __setitem__(self, key: str, value: Any):
+		self.lazy.pop(key, None)
+		self.values[key] = value
+
+	def __delitem__(self, key: str):
+		self.lazy.pop(key, None)
+		del self.values[key]
+
+	def __iter__(self) -> Iterator[str]:
+		return iter(self.values)
+
+	def __len__(self) -> int:
+		return len(self.values)
+
+	def __repr__(self) -> str:
+		return repr(dict(self))
+
+	def __reduce__(self):
+		return dict, (dict(self),)
+
+
+def flat_layout(vehicle_count: int, package_count: int) -> dict[str, slice]:
+	"""
+	Columns of every field in the flat observation. Each field of `flat_fields` holds one value
+	per vehicle or package, leaving out the empty vehicle & package 0.
+
+	:param vehicle_count: Number of vehicles including vehicle 0, like `ViennaEnv.vehicle_count`.
+	:param package_count: Number of packages including package 0.
+	:return: Field name -> slice of the flat observation.
+	"""
+	layout = {}
+	start = 0
+	for key in flat_fields:
+		stop = start + (vehicle_count if key.startswith('v_') else package_count) - 1
+		layout[key] = slice(start, stop)
+		start = stop
+	return layout
+
+
+def graph_observation_space(
+	place_count: int, vehicle_count: int, package_count: int, longest_transit: int
+) -> Dict:
+	"""
+	Observation space of the 'graph' observation mode.
+
+	:param place_count: Number of places including place 0, like `ViennaEnv.place_count`.
+	:param vehicle_count: Number of vehicles including vehicle 0.
+	:param package_count: Number of packages including package 0.
+	:param longest_transit: Highest value of the distance matrix.
+	"""
+	place_high = np.array([package_count, package_count, vehicle_count, vehicle_count]) - 1
+	vehicle_high = np.array([place_count - 1, 1, longest_transit, place_count - 1])
+
+	return Dict({
+		'places': Box(
+			low=0, high=np.broadcast_to(place_high, (place_count - 1, len(place_features))),
+			dtype=np.int16
+		),
+		'vehicles': Box(
+			low=0, high=np.broadcast_to(vehicle_high, (vehicle_count - 1, len(vehicle_features))),
+			dtype=np.int16
+		),
+	})
+
+
+def fill_graph_observation(environment: dict[str, np.array], places: np.array, vehicles: np.array):
+	"""
+	Summarizes the environment per place & per vehicle. Place 0, vehicle 0 & package 0 are left
+	out, so row `i` belongs to place/vehicle `i+1`. Place rows hold the fields of
+	`place_features`:
+
+	- waiting: packages waiting to be picked up at the place
+	- destined: undelivered packages with the place as target
+	- vehicles_stopped: vehicles standing at the place
+	- vehicles_heading: vehicles on their way to the place
+
+	Vehicle rows hold the fields of `vehicle_features`:
+
+	- position: place the vehicle stands at, or is heading to
+	- dispatchable: whether a dispatch would be followed in the next step
+	- transit_remaining: same as `v_transit_remaining`
+	- package_target: target of the package it carries, 0 if none
+
+	:param environment: Environment dictionary with a batch dimension in front of every array.
+	:param places: Output array of shape `(batch, place_count-1, 4)`.
+	:param vehicles: Output array of shape `(batch, vehicle_count-1, 4)`.
+	"""
+	batch, place_count = len(places), places.shape[1] + 1
+	rows = np.arange(batch)[:, None]
+
+	available = environment['v_available'][:, 1:]
+	remaining = environment['v_transit_remaining'][:, 1:]
+	transit_end = environment['v_transit_end'][:, 1:]
+	# an available vehicle stands at its start, every other one is at or heading to its end
+	position = np.where(available, environment['v_transit_start'][:, 1:], transit_end)
+	packages = environment['v_has_package'][:, 1:]
+	delivered = environment['p_delivered']
+	targets = environment['p_location_target']
+
+	def count(mask: np.array, place: np.array) -> np.array:
+		# number of `True` entries in `mask` per environment & place
+		flat_places = (rows * place_count + place)[mask]
+		return np.bincount(flat_places, minlength=batch * place_count) \
+			.reshape(batch, place_count)[:, 1:]
+
+	places[..., 0] = count(
+		~delivered & (environment['p_carrying_vehicle'] == 0), environment['p_location_current']
+	)
+	places[..., 1] = count(~delivered, targets)
+	places[..., 2] = count(remaining == 0, position)
+	places[..., 3] = count(remaining > 0, transit_end)
+
+	vehicles[..., 0] = position
+	vehicles[..., 1] = available & (remaining == 0)
+	vehicles[..., 2] = remaining
+	vehicles[..., 3] = np.where(
+		(packages != 0) & ~delivered[rows, packages], targets[rows, packages], 0
+	)
+
+
 def filler(
 	amount: int, fill_with: Any = 0, random_int_up_to_fill: bool = False,
-	zero_at_start = False
+	zero_at_start = False, generator: random.Random = random
 ) -> np.array:
 	"""
 	:param amount: Length of list to return.
@@ -458,13 +928,14 @@ def filler(
 		random integer in range of `[0, fill_with)`
 	:param random_int_up_to_fill: Choice to randomize an integer range.
 	:param zero_at_start: Whether to replace the 1st value with a 0.
+	:param generator: Source of the random integers, the global `random` module by default.
 	:return: `np.array` of shape `(amount,)`.
 	"""
 	
 	if random_int_up_to_fill:
 		# starts at one for generating random place locations in the environment
 		#result = [random.randrange(1, fill_with) for _ in range(amount)]
-		result = random.sample(range(1, fill_with), amount)
+		result = generator.sample(range(1, fill_with), amount)
 	else:
 		result = [fill_with] * amount
 	
@@ -0,0 +1,288 @@
+from typing import Callable
+import argparse
+import json
+import os
+import platform
+import re
+import time
+from datetime import datetime
+import numpy as np
+from distances import create_distance_matrix
+from ViennaEnv import ViennaEnv
+
+benchmark_path = '../benchmarks/'
+
+# (place_count, vehicle_count, package_count) of the environments benchmarked by default
+default_sizes = ((20, 5, 10), (80, 10, 20), (80, 30, 40))
+
+
+def machine_info() -> dict[str, str]:
+	"""
+	:return: Description of this machine & the installed versions, stored with every baseline
+		so that only comparable runs are compared.
+	"""
+	return {
+		'node': platform.node(),
+		'machine': platform.machine(),
+		'processor': platform.processor(),
+		'cpus': str(os.cpu_count()),
+		'system': platform.system(),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+	}
+
+
+def machine_tag() -> str:
+	"""
+	:return: Short name of this machine used for the baseline file name.
+	"""
+	return re.sub(r'[^\w.-]', '_', f'{platform.node()}-{platform.machine()}')
+
+
+def measure(
+	function: Callable[[], None], setup: Callable[[], None] = None,
+	repeats: int = 7, min_time: float = .05
+) -> dict[str, float]:
+	"""
+	Times `function` similar to `timeit`. The number of calls per repeat is raised until a
+	repeat takes at least `min_time` seconds, then the fastest & the median time per call of
+	`repeats` repeats are kept. If `setup` is given, it runs before every call & each call is
+	timed on its own, leaving the setup out.
+
+	:return: 'median_us', 'min_us' & 'calls', the times in microseconds.
+	"""
+	def run(number: int) -> float:
+		if setup is None:
+			start = time.perf_counter()
+			for _ in range(number):
+				function()
+			return time.perf_counter() - start
+
+		total = 0
+		for _ in range(number):
+			setup()
+			start = time.perf_counter()
+			function()
+			total += time.perf_counter() - start
+		return total
+
+	number = 1
+	while (elapsed := run(number)) < min_time and number < 1_000_000:
+		number *= 10 if elapsed < min_time / 10 else 2
+
+	per_call = [run(number) / number for _ in range(repeats)]
+	return {
+		'median_us': float(np.median(per_call)) * 1e6,
+		'min_us': min(per_call) * 1e6,
+		'calls': number * repeats,
+	}
+
+
+def stepping(env: ViennaEnv, actions: np.array) -> Callable[[], None]:
+	"""
+	:return: Function that runs one step with the next of `actions`, resetting when done.
+	"""
+	index = 0
+
+	def step():
+		nonlocal index
+		if env.step(actions[index % len(actions)])[2]:
+			env.reset()
+		index += 1
+
+	return step
+
+
+def benchmark_size(
+	place_count: int, vehicle_count: int, package_count: int, include: set[str],
+	backend: str = 'numpy'
+) -> dict[str, dict[str, float]]:
+	"""
+	Runs every benchmark in `include` for one environment size.
+
+	:param backend: Backend of the environments, see `ViennaEnv`.
+	:return: Benchmark name -> timing, see `measure`.
+	"""
+	options = dict(
+		place_count=place_count, vehicle_count=vehicle_count, package_count=package_count,
+		backend=backend
+	)
+	rng = np.random.default_rng(0)
+	random_actions = rng.integers(0, place_count + 1, (4096, vehicle_count))
+	results = {}
+
+	if 'distance_matrix' in include:
+		results['distance_matrix'] = measure(lambda: create_distance_matrix(place_count))
+
+	env = ViennaEnv(**options, info_level='full')
+	env.reset(seed=0)
+
+	if 'reset' in include:
+		results['reset'] = measure(env.reset)
+
+	if 'step_random' in include:
+		env.reset(seed=0)
+		results['step_random'] = measure(stepping(env, random_actions))
+
+	if 'step_idle' in include:
+		env.reset(seed=0)
+		results['step_idle'] = measure(stepping(env, np.zeros((1, vehicle_count), dtype=int)))
+
+	if 'tick' in include:
+		# the kernel of the backend from the middle of an episode, where packages are waiting,
+		# carried & delivered, without the validation, observation & info around it in `step`
+		env.reset(seed=0)
+		step = stepping(env, random_actions)
+		for _ in range(50):
+			step()
+		state = env.get_state()
+		results['tick'] = measure(
+			lambda: env.tick(random_actions[50]), setup=lambda: env.set_state(state)
+		)
+
+	if include & {'vec_rollout', 'predict'}:
+		from stable_baselines3 import PPO
+		from stable_baselines3.common.env_util import make_vec_env
+
+		vec_env = make_vec_env(
+			ViennaEnv, n_envs=4, env_kwargs=dict(**options, info_level='none'), seed=0
+		)
+		vec_env.reset()
+
+		if 'vec_rollout' in include:
+			vec_actions = rng.integers(0, place_count + 1, (4096, 4, vehicle_count))
+			index = 0
+
+			def vec_step():
+				nonlocal index
+				vec_env.step(vec_actions[index % len(vec_actions)])
+				index += 1
+			results['vec_rollout'] = measure(vec_step)
+
+		if 'predict' in include:
+			model = PPO('MultiInputPolicy', vec_env, seed=0, device='cpu')
+			observation, _ = env.reset(seed=0)
+			results['predict'] = measure(lambda: model.predict(observation, deterministic=True))
+
+		vec_env.close()
+
+	if 'draw' in include:
+		os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # no window needed
+		from visualizer import Visualizer
+
+		visualizer = Visualizer(options)
+		env.reset(seed=0)
+		info = env.step(random_actions[0])[4]
+		results['draw'] = measure(lambda: visualizer.draw(info))
+
+	return results
+
+
+benchmark_names = (
+	'distance_matrix', 'reset', 'step_random', 'step_idle', 'tick',
+	'vec_rollout', 'predict', 'draw',
+)
+
+
+def run_benchmarks(
+	sizes: tuple[tuple[int, int, int], ...] = default_sizes,
+	include: tuple[str, ...] = benchmark_names,
+	output: str = None, backend: str = 'numpy'
+) -> dict:
+	"""
+	Runs the benchmarks for every size & stores them as a baseline.
+
+	:param output: File to write, defaults to `benchmark_path` + the machine tag.
+	:param backend: Backend of the environments, see `ViennaEnv`.
+	:return: The stored baseline, results are keyed by '<benchmark>/<places>-<vehicles>-<packages>'.
+	"""
+	baseline = {
+		'machine': machine_info(),
+		'created': datetime.now().strftime('%y-%m-%d_%H-%M-%S'),
+		'backend': backend,
+		'results': {},
+	}
+
+	for size in sizes:
+		for name, timing in benchmark_size(*size, set(include), backend).items():
+			key = f'{name}/{"-".join(map(str, size))}'
+			baseline['results'][key] = timing
+			print(f'{key:<32} {timing["median_us"]:>12.2f} us')
+
+	output = output or f'{benchmark_path}{machine_tag()}.json'
+	os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+	with open(output, 'w') as f:
+		json.dump(baseline, f, indent='\t')
+	print(f'Wrote {output}')
+
+	return baseline
+
+
+def compare_benchmarks(baseline_file: str, current_file: str, threshold: float = .1) -> list[str]:
+	"""
+	Compares the median times of two benchmark files & prints every benchmark found in both.
+
+	:param threshold: Relative slowdown from which a benchmark counts as a regression.
+	:return: Keys of the regressed benchmarks.
+	"""
+	with open(baseline_file) as f:
+		baseline = json.load(f)
+	with open(current_file) as f:
+		current = json.load(f)
+
+	if baseline['machine'] != current['machine']:
+		print('Warning: the files were created on different machines or versions.')
+	if baseline.get('backend', 'numpy') != current.get('backend', 'numpy'):
+		print('Warning: the files were created with different backends.')
+
+	regressions = []
+	for key in sorted(baseline['results'].keys() & current['results'].keys()):
+		before = baseline['results'][key]['median_us']
+		after = current['results'][key]['median_us']
+		change = after / before - 1
+
+		if change > threshold:
+			verdict = 'REGRESSION'
+			regressions.append(key)
+		elif change < -threshold:
+			verdict = 'faster'
+		else:
+			verdict = ''
+		print(f'{key:<32} {before:>12.2f} -> {after:>12.2f} us {change:>+8.1%} {verdict}')
+
+	print(f'{len(regressions)} regressions beyond {threshold:.0%}.')
+	return regressions
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmarks the environment & its surroundings.')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	run_parser = commands.add_parser('run', help='run the benchmarks & store a baseline')
+	run_parser.add_argument(
+		'--sizes', type=str, nargs='+', default=['-'.join(map(str, s)) for s in default_sizes],
+		help='environment sizes as place-vehicle-package, e.g. 20-5-10'
+	)
+	run_parser.add_argument(
+		'--only', type=str, nargs='+', choices=benchmark_names, default=list(benchmark_names)
+	)
+	run_parser.add_argument('--output', type=str, default=None)
+	run_parser.add_argument('--backend', type=str, choices=['numpy', 'numba'], default='numpy')
+
+	compare_parser = commands.add_parser('compare', help='flag regressions against a baseline')
+	compare_parser.add_argument('baseline', type=str)
+	compare_parser.add_argument('current', type=str)
+	compare_parser.add_argument('--threshold', type=float, default=.1)
+
+	arguments = parser.parse_args()
+
+	match arguments.command:
+		case 'run':
+			run_benchmarks(
+				tuple(tuple(map(int, size.split('-'))) for size in arguments.sizes),
+				tuple(arguments.only),
+				arguments.output, arguments.backend
+			)
+		case 'compare':
+			if compare_benchmarks(arguments.baseline, arguments.current, arguments.threshold):
+				raise SystemExit(1)
@@ -0,0 +1,350 @@
+import copy
+import json
+import os
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+from warnings import warn
+import numpy as np
+from stable_baselines3.common.base_class import BaseAlgorithm
+from stable_baselines3.common.callbacks import BaseCallback
+from stable_baselines3.common.save_util import recursive_getattr, save_to_zip_file
+
+
+def merge_stats(stats: list[dict[str, dict[str, float]]]) -> dict[str, dict[str, float]]:
+	"""
+	Adds up the `ViennaEnv.stats` of several environments.
+
+	:return: Same format as `ViennaEnv.stats`.
+	"""
+	merged = {}
+	for env_stats in stats:
+		for phase, values in env_stats.items():
+			total = merged.setdefault(phase, {'calls': 0, 'total_s': 0.})
+			total['calls'] += values['calls']
+			total['total_s'] += values['total_s']
+
+	for total in merged.values():
+		total['mean_us'] = total['total_s'] / total['calls'] * 1e6
+
+	return merged
+
+
+class ProfilingCallback(BaseCallback):
+	def __init__(self, verbose: int = 0):
+		"""
+		Writes the profiling results of the environments (created with `profile=True`) to the
+		SB3 logger after every rollout, under 'env_profile/'. Next to the average time of each
+		phase, 'env_profile/env_share' is the part of the rollout spent inside the environments,
+		the rest went into the policy & the vectorized environment.
+		"""
+		super().__init__(verbose)
+		self.rollout_start = 0.
+		self.env_time = 0.  # total time spent in the environments at the start of the rollout
+		self.enabled = True
+
+	def collect(self) -> dict[str, dict[str, float]]:
+		"""
+		:return: Merged profiling results of every environment, empty if they cannot profile.
+		"""
+		if not self.enabled:
+			return {}
+
+		# read past the `Monitor` wrapper like `TelemetryCallback.episode_progress`. The totals
+		# behind `ViennaEnv.stats` are read instead of the method, which the workers of
+		# `--vec_env subproc` would have to send back together with their whole environment.
+		def read(name: str) -> list:
+			return self.training_env.env_method('get_wrapper_attr', name)
+
+		try:
+			return merge_stats([
+				{
+					phase: {'calls': calls, 'total_s': times[phase]}
+					for phase, calls in env_calls.items() if calls
+				} for times, env_calls in zip(read('phase_times'), read('phase_calls'))
+			])
+		except AttributeError:
+			warn('The training environments have no profiling results, e.g. `--vec_env native`.')
+			self.enabled = False
+			return {}
+
+	def _on_rollout_start(self):
+		self.rollout_start = time.perf_counter()
+		self.env_time = sum(values['total_s'] for values in self.collect().values())
+
+	def _on_step(self) -> bool:
+		return True
+
+	def _on_rollout_end(self):
+		stats = self.collect()
+		if not stats:
+			return
+
+		env_time = sum(values['total_s'] for values in stats.values())
+		rollout_time = time.perf_counter() - self.rollout_start
+
+		for phase, values in stats.items():
+			self.logger.record(f'env_profile/{phase}_us', values['mean_us'])
+			self.logger.record(f'env_profile/{phase}_share', values['total_s'] / env_time)
+		self.logger.record(
+			'env_profile/env_share', (env_time - self.env_time) / max(rollout_time, 1e-9)
+		)
+
+
+class TelemetryCallback(BaseCallback):
+	def __init__(self,
+		path: str, interval: int = 10_000, run_name: str = None, env_progress: bool = True,
+		verbose: int = 0
+	):
+		"""
+		Measures the training throughput & appends one JSON record per `interval` environment
+		steps to `path`, which stays easy to parse while the run is going. The same values are
+		written to the SB3 logger under 'telemetry/'. A record holds:
+
+		- steps_per_second: environment steps of all environments per second since the last
+			record
+		- rollout_seconds & update_seconds: time spent collecting rollouts & updating the
+			policy since the last record
+		- rollout_steps_per_second: steps per second while collecting rollouts only
+		- episodes, episode_length_mean/max & episode_reward_mean: episodes finished since the
+			last record, taken from the 'episode' info of `Monitor`
+		- delivered_fraction: part of the packages delivered in the running episodes
+		- clock_max: clock of the longest running episode, which keeps growing when an episode
+			stalls
+
+		:param path: JSONL file the records are appended to.
+		:param run_name: Stored in every record, e.g. the model name.
+		:param env_progress: Read 'delivered_fraction' & 'clock_max' from the training
+			environments, which is pointless if they are not stepped, like with actors.
+		"""
+		super().__init__(verbose)
+		self.path = path
+		self.interval = interval
+		self.run_name = run_name
+		self.env_progress = env_progress
+
+		self.last_steps = 0
+		self.last_time = 0.
+		self.rollout_seconds = 0.
+		self.update_seconds = 0.
+		self.phase_start = 0.
+		self.in_rollout = False
+		self.episode_lengths = []
+		self.episode_rewards = []
+
+	def _on_training_start(self):
+		self.last_steps = self.num_timesteps
+		self.last_time = self.phase_start = time.perf_counter()
+		self.write({'event': 'start', 'environments': self.training_env.num_envs})
+
+	def end_phase(self) -> float:
+		"""
+		Adds the time since the start of the current phase to the rollout or update time.
+
+		:return: The current time.
+		"""
+		now = time.perf_counter()
+		if self.in_rollout:
+			self.rollout_seconds += now - self.phase_start
+		else:
+			self.update_seconds += now - self.phase_start
+		self.phase_start = now
+		return now
+
+	def _on_rollout_start(self):
+		self.end_phase()
+		self.in_rollout = True
+
+	def _on_rollout_end(self):
+		self.end_phase()
+		self.in_rollout = False
+
+	def _on_step(self) -> bool:
+		for info in self.locals.get('infos', ()):
+			if 'episode' in info:
+				self.episode_lengths.append(info['episode']['l'])
+				self.episode_rewards.append(info['episode']['r'])
+
+		if self.num_timesteps - self.last_steps >= self.interval:
+			self.record()
+		return True
+
+	def _on_training_end(self):
+		self.record('end')
+
+	def record(self, event: str = 'interval'):
+		"""
+		Writes the values measured since the last record & starts measuring again.
+		"""
+		now = self.end_phase()
+		steps = self.num_timesteps - self.last_steps
+		values = {
+			'steps_per_second': steps / max(now - self.last_time, 1e-9),
+			'rollout_steps_per_second': steps / max(self.rollout_seconds, 1e-9),
+			'rollout_seconds': self.rollout_seconds,
+			'update_seconds': self.update_seconds,
+			'episodes': len(self.episode_lengths),
+		}
+		if self.episode_lengths:
+			values['episode_length_mean'] = float(np.mean(self.episode_lengths))
+			values['episode_length_max'] = int(np.max(self.episode_lengths))
+			values['episode_reward_mean'] = float(np.mean(self.episode_rewards))
+		if self.env_progress:
+			values.update(self.episode_progress())
+
+		for key, value in values.items():
+			self.logger.record(f'telemetry/{key}', value)
+		self.write({'event': event, **values})
+
+		self.last_steps = self.num_timesteps
+		self.last_time = now
+		self.rollout_seconds = self.update_seconds = 0.
+		self.episode_lengths, self.episode_rewards = [], []
+
+	def episode_progress(self) -> dict[str, float]:
+		"""
+		:return: 'delivered_fraction' & 'clock_max' of the running episodes, empty if the
+			environments do not provide them.
+		"""
+		# read past the `Monitor` wrapper, `get_attr` warns about forwarding through it
+		def read(name: str) -> list:
+			return self.training_env.env_method('get_wrapper_attr', name)
+
+		try:
+			undelivered = read('undelivered_count')
+			clocks = read('clock')
+			packages = read('package_count')[0] - 1
+		except AttributeError:
+			return {}
+
+		# the native vectorized environment holds the values of every environment in one array
+		if isinstance(undelivered[0], np.ndarray):
+			undelivered, clocks = undelivered[0], clocks[0]
+
+		return {
+			'delivered_fraction': 1 - float(np.mean(undelivered)) / max(packages, 1),
+			'clock_max': int(np.max(clocks)),
+		}
+
+	def write(self, record: dict):
+		"""
+		Appends a record to the JSONL file, along with the time, run & timestep count.
+		"""
+		record = {
+			'time': datetime.now().isoformat(timespec='seconds'),
+			'run': self.run_name,
+			'timesteps': self.num_timesteps,
+			**record,
+		}
+		with open(self.path, 'a') as f:
+			f.write(json.dumps(record) + '\n')
+
+
+checkpoint_path = 'models/checkpoints/'
+
+
+def checkpoint_name(model_name: str, timesteps: int) -> str:
+	return f'{model_name}_{timesteps}_steps.zip'
+
+
+def find_checkpoints(model_name: str, directory: str = checkpoint_path) -> list[tuple[int, str]]:
+	"""
+	:return: Timesteps & path of every checkpoint of the model, oldest first.
+	"""
+	if not os.path.isdir(directory):
+		return []
+
+	pattern = re.compile(rf'^{re.escape(model_name)}_(\d+)_steps\.zip$')
+	return sorted(
+		(int(match.group(1)), os.path.join(directory, file_name))
+		for file_name in os.listdir(directory)
+		if (match := pattern.match(file_name))
+	)
+
+
+def snapshot(model: BaseAlgorithm) -> tuple[dict, dict, dict]:
+	"""
+	Copies everything `BaseAlgorithm.save` writes, so that it can be written while the
+	training goes on. The last observation is left out, it is discarded when loading anyway.
+
+	:return: The data, parameters & pytorch variables for `save_to_zip_file`.
+	"""
+	exclude = set(model._excluded_save_params()) | {'_last_obs', '_last_original_obs'}
+	state_dicts_names, torch_variable_names = model._get_torch_save_params()
+	exclude |= {name.split('.')[0] for name in state_dicts_names + torch_variable_names}
+
+	data = {key: value for key, value in model.__dict__.items() if key not in exclude}
+	pytorch_variables = {name: recursive_getattr(model, name) for name in torch_variable_names}
+	return copy.deepcopy((data, model.get_parameters(), pytorch_variables))
+
+
+class CheckpointCallback(BaseCallback):
+	def __init__(self,
+		model_name: str, interval: int = 100_000, keep: int = 3,
+		directory: str = checkpoint_path, verbose: int = 0
+	):
+		"""
+		Saves the model every `interval` environment steps as
+		`<directory>/<model_name>_<timesteps>_steps.zip`, which `algorithm.load` reads like any
+		saved model, including the optimizer state & the timestep counter. The model is saved
+		between two rollouts, when the policy is not changing: only a copy of it is taken then,
+		the file is written by a background thread, so the rollout collection is not stalled.
+		Each file is written under a temporary name 1st, a crash while writing never leaves a
+		broken checkpoint behind.
+
+		:param keep: Number of checkpoints kept, older ones are deleted. 0 keeps all of them.
+		"""
+		super().__init__(verbose)
+		self.model_name = model_name
+		self.interval = interval
+		self.keep = keep
+		self.directory = directory
+
+		self.last_saved = 0
+		self.queue = None
+		self.writer = None
+
+	def _on_training_start(self):
+		os.makedirs(self.directory, exist_ok=True)
+		# continues the count of a resumed model
+		self.last_saved = self.num_timesteps
+		self.queue = queue.Queue(1)
+		self.writer = threading.Thread(target=self.write_checkpoints, daemon=True)
+		self.writer.start()
+
+	def _on_rollout_start(self):
+		if self.num_timesteps - self.last_saved >= self.interval:
+			self.save()
+
+	def _on_step(self) -> bool:
+		return True
+
+	def _on_training_end(self):
+		self.queue.put(None)
+		self.writer.join()
+
+	def save(self):
+		"""
+		Hands a copy of the model to the background writer, waiting only if it is still busy
+		with the previous checkpoint.
+		"""
+		self.last_saved = self.num_timesteps
+		self.queue.put((self.num_timesteps, snapshot(self.model)))
+
+	def write_checkpoints(self):
+		while (item := self.queue.get()) is not None:
+			timesteps, (data, parameters, pytorch_variables) = item
+			path = os.path.join(self.directory, checkpoint_name(self.model_name, timesteps))
+
+			save_to_zip_file(
+				path + '.tmp', data=data, params=parameters, pytorch_variables=pytorch_variables
+			)
+			os.replace(path + '.tmp', path)
+			if self.verbose:
+				print(f'Saved checkpoint {path}')
+
+			if self.keep:
+				for _, old_path in find_checkpoints(self.model_name, self.directory)[:-self.keep]:
+					os.remove(old_path)
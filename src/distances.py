@@ -1,44 +1,324 @@
-import pandas as pd
 import numpy as np
+import os
+import atexit
+import hashlib
+from multiprocessing import shared_memory
+from typing import NamedTuple
+from warnings import warn
 
-def create_distance_matrix(env_places: int = 20, buffer: int = 2) -> np.array:
+travel_times_file = '../data/travel_times/wien_travel_times.csv'
+travel_tensor_file = '../data/travel_times/wien_travel_times.npy'
+
+# order of the travel modes along the 2nd axis of the travel tensor
+travel_modes = ('walking', 'transit', 'bicycling', 'driving')
+# indices along the 1st axis of the travel tensor
+DURATION, DISTANCE = 0, 1
+# total number of places in the travel times file
+PLACES_TOTAL = 80
+
+# matrices already built in this process, keyed by `(env_places, buffer, mode, file signature)`
+_matrix_cache: dict[tuple, np.array] = {}
+# nearest neighbour edges already built in this process, keyed like `_matrix_cache` + neighbours
+_edge_cache: dict[tuple, tuple[np.array, np.array]] = {}
+# memory map of the travel tensor, keyed by file signature
+_tensor_cache: dict[tuple, np.memmap] = {}
+# file signature of the csv the travel tensor was last checked against in this process
+_checked_source: tuple[int, int] | None = None
+# shared memory blocks created by this process, which are unlinked on shutdown
+_shared_owned: dict[str, shared_memory.SharedMemory] = {}
+# shared memory blocks this process has attached to, kept open while their arrays are in use
+_shared_attached: dict[str, shared_memory.SharedMemory] = {}
+
+
+class SharedMatrixInfo(NamedTuple):
+	"""
+	Everything a worker process needs to attach to a distance matrix in shared memory. This is
+	small & picklable, so it can be passed through `env_kwargs` to subprocess environments.
+	"""
+	name: str
+	shape: tuple[int, int]
+	dtype: str
+
+
+def build_travel_tensor(
+	input_file: str = travel_times_file, output_file: str = travel_tensor_file
+) -> np.array:
+	"""
+	Converts the travel times csv into a compact binary `.npy` file that can be memory mapped.
+	The tensor has the shape `(2, modes, 81, 81)`, where the 1st axis holds the durations in
+	minutes (rounded to the nearest integer) & the distances in meters, both as `uint16`. Like
+	the distance matrix, the 0th row/column of every place dimension is left blank & both sides
+	of the diagonal are filled. The sha256 of the csv is written next to the tensor, so that
+	`load_travel_tensor` rebuilds it once the csv changes. Can also be run with
+	`python distances.py` from the source directory.
+
+	:return: The tensor that was written.
+	"""
+	import pandas as pd  # only needed to build the tensor, not to load it
+
+	distances = pd.read_csv(input_file, sep=';', encoding="ISO-8859-1")
+
+	mode = distances['mode'].map({name: index for index, name in enumerate(travel_modes)})
+	place1 = distances['place1index'].to_numpy() + 1
+	place2 = distances['place2index'].to_numpy() + 1
+	durations = np.rint(distances['duration'].to_numpy())
+	meters = distances['distance'].to_numpy()
+
+	assert not mode.isna().any(), 'Unknown travel mode in travel times file.'
+	assert max(durations.max(), meters.max()) <= np.iinfo(np.uint16).max, \
+		'Travel times do not fit into uint16.'
+
+	tensor = np.zeros(
+		(2, len(travel_modes), PLACES_TOTAL+1, PLACES_TOTAL+1), dtype=np.uint16
+	)
+	mode = mode.to_numpy()
+	for measure, values in ((DURATION, durations), (DISTANCE, meters)):
+		tensor[measure, mode, place1, place2] = values
+		tensor[measure, mode, place2, place1] = values
+
+	np.save(output_file, tensor)
+	with open(_source_hash_file(output_file), 'w') as file:
+		file.write(_file_hash(input_file))
+
+	return tensor
+
+
+def load_travel_tensor() -> np.memmap:
+	"""
+	Opens the binary travel tensor as a read-only memory map. Every process that loads the file
+	(including forked subprocess workers) shares the same physical pages. If the file does not
+	exist yet or was built from a different csv, it is built from the csv 1st, see
+	`_update_travel_tensor`.
+
+	:return: `np.memmap` of shape `(2, modes, 81, 81)`, see `build_travel_tensor`.
 	"""
-	Uses the travel times file to generate a matrix of the distances between them, rounded to
+	_update_travel_tensor()
+
+	key = _file_signature(travel_tensor_file)
+
+	if key not in _tensor_cache:
+		_tensor_cache.clear()
+		_tensor_cache[key] = np.load(travel_tensor_file, mmap_mode='r')
+
+	return _tensor_cache[key]
+
+
+def create_distance_matrix(
+	env_places: int = 20, buffer: int = 2, mode: str = 'bicycling'
+) -> np.array:
+	"""
+	Uses the travel tensor to generate a matrix of the distances between them, rounded to
 	the nearest integer + 2.
-	
+
 	:param env_places: Specified number of places in the environment.
 	:param buffer: Increase all values by a certain amount before assigning to matrix. The
 		default value is 2 minutes as an approximate time it takes to pickup/unload a package.
+	:param mode: Travel mode to read from the file, one of 'walking', 'transit', 'bicycling'
+		or 'driving'.
 	:return: Numpy array of shape `(env_places, env_places)`
 	"""
 
-	distances = pd.read_csv(
-		'../data/travel_times/wien_travel_times.csv',
-		sep = ';',
-		encoding = "ISO-8859-1"
-	)
-
-	distances = distances[distances['mode'] == 'bicycling']
+	durations = load_travel_tensor()[DURATION, travel_modes.index(mode)]
 
 	"""
-	Dimensions have +1 appended to have the 0th row/column be blank. This is to keep in line 
+	Dimensions have +1 appended to have the 0th row/column be blank. This is to keep in line
 	with the environment, where dispatching to place 0 indicates the vehicle should not move yet.
 	"""
 	dist_matrix = np.zeros((env_places+1, env_places+1), dtype=int)
 
-	for place1 in range(env_places):
-		for place2 in range(place1+1, env_places):
-			"""
-			This sets the values on both sides of the diagonal, thus it is mirrored.
-			The indices here are also offset by +1 as explained in the previous block comment.
-			"""
-			dist_matrix[place1+1, place2+1], dist_matrix[place2+1, place1+1] = 2 * [round(
-				distances[
-					(distances['place1index'] == place1) &
-					(distances['place2index'] == place2)
-				]['duration'].values[0]
-			) + buffer]  # artificially increase all transit times to simulate loading times
+	# artificially increase all transit times to simulate loading times, except for the blank
+	# 0th row/column & the diagonal
+	dist_matrix[1:, 1:] = durations[1:env_places+1, 1:env_places+1] + buffer
+	np.fill_diagonal(dist_matrix, 0)
+
+	return dist_matrix
+
+
+def get_distance_matrix(
+	env_places: int = 20, buffer: int = 2, mode: str = 'bicycling'
+) -> np.array:
+	"""
+	Cached version of `create_distance_matrix`. The travel tensor is only read the 1st time a
+	combination of arguments is requested, every later call in the same process gets the same
+	array back. The modification time & size of the file are part of the cache key, so
+	rebuilding the file builds a fresh matrix.
+
+	:return: Read-only numpy array of shape `(env_places+1, env_places+1)`. Callers that need
+		to modify the matrix should make a copy.
+	"""
+	_update_travel_tensor()
+
+	key = (env_places, buffer, mode, _file_signature(travel_tensor_file))
+
+	if key not in _matrix_cache:
+		dist_matrix = create_distance_matrix(env_places, buffer, mode)
+		dist_matrix.setflags(write=False)
+		_matrix_cache[key] = dist_matrix
+
+	return _matrix_cache[key]
+
+
+def get_neighbour_edges(
+	env_places: int = 20, neighbours: int = 8, buffer: int = 2, mode: str = 'bicycling'
+) -> tuple[np.array, np.array]:
+	"""
+	Connects every place to the `neighbours` places with the shortest travel time from it, which
+	keeps the number of edges at `env_places * neighbours` instead of `env_places ** 2`. The
+	edges point from the neighbour to the place, so that each place receives exactly
+	`neighbours` messages in a graph network. Places are numbered from 0 here, thus node `i` is
+	place `i+1` of the distance matrix. Cached like `get_distance_matrix`.
+
+	:param neighbours: Edges per place, at most `env_places - 1`.
+	:return: Read-only edge index of shape `(2, edges)` holding the source & target nodes, &
+		the travel time of every edge.
+	"""
+	neighbours = min(neighbours, env_places - 1)
+	dist_matrix = get_distance_matrix(env_places, buffer, mode)
+	key = (env_places, buffer, mode, _file_signature(travel_tensor_file), neighbours)
+
+	if key not in _edge_cache:
+		durations = dist_matrix[1:, 1:].copy()
+		np.fill_diagonal(durations, np.iinfo(durations.dtype).max)  # no edge to itself
+		nearest = np.argsort(durations, axis=1, kind='stable')[:, :neighbours]
+
+		places = np.repeat(np.arange(env_places), neighbours)
+		edge_index = np.stack((nearest.reshape(-1), places))
+		travel_times = durations[places, edge_index[0]]
+
+		edge_index.setflags(write=False)
+		travel_times.setflags(write=False)
+		_edge_cache[key] = edge_index, travel_times
+
+	return _edge_cache[key]
+
+
+def clear_distance_cache():
+	"""
+	Drops every cached matrix & the memory mapped travel tensor so the next
+	`get_distance_matrix` call reads the file again. Arrays already handed out stay valid for
+	whoever holds them.
+	"""
+	_matrix_cache.clear()
+	_edge_cache.clear()
+	_tensor_cache.clear()
+
+
+def share_distance_matrix(
+	env_places: int = 20, buffer: int = 2, mode: str = 'bicycling'
+) -> SharedMatrixInfo:
+	"""
+	Copies the distance matrix into a new `multiprocessing.shared_memory` block once, so that
+	every worker can attach to the same physical memory instead of holding its own copy. This
+	should be called in the parent process before the workers are started. The block is
+	unlinked when the parent exits, or earlier with `release_shared_distance_matrix`.
+
+	:return: Info to pass to `attach_distance_matrix` in the workers.
+	"""
+	dist_matrix = get_distance_matrix(env_places, buffer, mode)
+
+	block = shared_memory.SharedMemory(create=True, size=dist_matrix.nbytes)
+	shared = np.ndarray(dist_matrix.shape, dtype=dist_matrix.dtype, buffer=block.buf)
+	shared[:] = dist_matrix
+	_shared_owned[block.name] = block
+
+	return SharedMatrixInfo(block.name, dist_matrix.shape, dist_matrix.dtype.str)
+
+
+def attach_distance_matrix(info: SharedMatrixInfo) -> np.array:
+	"""
+	Attaches to a distance matrix created by `share_distance_matrix` without copying it. Calls
+	with the same info in one process return views of the same block.
+
+	:return: Read-only numpy array backed by the shared memory block.
+	"""
+	if info.name in _shared_owned:
+		block = _shared_owned[info.name]
+	else:
+		if info.name not in _shared_attached:
+			_shared_attached[info.name] = shared_memory.SharedMemory(name=info.name)
+		block = _shared_attached[info.name]
+
+	dist_matrix = np.ndarray(info.shape, dtype=np.dtype(info.dtype), buffer=block.buf)
+	dist_matrix.setflags(write=False)
 
 	return dist_matrix
 
 
+@atexit.register
+def release_shared_distance_matrix(info: SharedMatrixInfo = None):
+	"""
+	Closes & unlinks shared distance matrices created by this process. Workers still attached
+	keep their mapping until they exit. Registered to run on shutdown of the parent.
+
+	:param info: Matrix to release, releases all matrices of this process when left empty.
+	"""
+	names = list(_shared_owned) if info is None else [info.name]
+
+	for name in names:
+		block = _shared_owned.pop(name, None)
+		if block is None:
+			continue
+		try:
+			block.close()
+		except BufferError:
+			pass  # arrays created in this process still reference the block
+		block.unlink()
+
+
+def _update_travel_tensor():
+	"""
+	Builds the travel tensor if it is missing or the sha256 stored next to it does not match
+	the csv anymore. The csv is only hashed again once its modification time or size changed
+	since the last check of this process. Without the csv, the tensor is used as it is.
+	"""
+	global _checked_source
+
+	if not os.path.exists(travel_times_file):
+		return
+
+	signature = _file_signature(travel_times_file)
+	if signature == _checked_source and os.path.exists(travel_tensor_file):
+		return
+
+	if not os.path.exists(travel_tensor_file):
+		build_travel_tensor(travel_times_file, travel_tensor_file)
+	else:
+		try:
+			with open(_source_hash_file(travel_tensor_file)) as file:
+				built_from = file.read().strip()
+		except FileNotFoundError:
+			built_from = None
+
+		if built_from != _file_hash(travel_times_file):
+			warn(f'{travel_times_file} changed since {travel_tensor_file} was built, rebuilding it.')
+			build_travel_tensor(travel_times_file, travel_tensor_file)
+
+	_checked_source = signature
+
+
+def _source_hash_file(tensor_file: str) -> str:
+	"""
+	:return: Path of the file holding the sha256 of the csv a travel tensor was built from.
+	"""
+	return f'{tensor_file}.sha256'
+
+
+def _file_hash(path: str) -> str:
+	"""
+	:return: Hex sha256 of the contents of `path`.
+	"""
+	with open(path, 'rb') as file:
+		return hashlib.sha256(file.read()).hexdigest()
+
+
+def _file_signature(path: str) -> tuple[int, int]:
+	"""
+	:return: Modification time in nanoseconds & size in bytes of `path`.
+	"""
+	stat = os.stat(path)
+	return stat.st_mtime_ns, stat.st_size
+
+
+if __name__ == '__main__':
+	build_travel_tensor()
+	print(f'Wrote {travel_tensor_file}')
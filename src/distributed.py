@@ -0,0 +1,384 @@
+from typing import Any
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+import multiprocessing as mp
+import ipaddress
+import pickle
+import queue
+import secrets
+import socket
+import sys
+import threading
+import time
+import numpy as np
+import torch as th
+from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.type_aliases import MaybeCallback
+from stable_baselines3.common.on_policy_algorithm import OnPolicyAlgorithm
+from stable_baselines3.common.utils import obs_as_tensor, safe_mean
+from ViennaEnv import ViennaEnv
+
+default_address = ('localhost', 6000)
+
+
+def parse_address(address: str) -> tuple[str, int]:
+	"""
+	:param address: 'host:port', e.g. 'localhost:6000'.
+	"""
+	host, port = address.rsplit(':', 1)
+	return host, int(port)
+
+
+def is_loopback(host: str) -> bool:
+	"""
+	:return: Whether `host` only accepts connections from this machine.
+	"""
+	try:
+		return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+	except (socket.gaierror, ValueError):
+		return False
+
+
+def send(connection: Connection, message: Any):
+	connection.send_bytes(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def receive(connection: Connection) -> Any:
+	return pickle.loads(connection.recv_bytes())
+
+
+class Rollout:
+	def __init__(self, steps: int, env_count: int):
+		"""
+		Trajectories of the environments of one actor, which are sent to the learner. Every list
+		holds one batch per step, as passed to `RolloutBuffer.add`.
+		"""
+		self.observations = []
+		self.actions = []
+		self.rewards = []
+		self.episode_starts = []
+		self.values = []
+		self.log_probs = []
+		self.episodes = []  # 'episode' info of every finished episode, see `Monitor`
+		self.last_values = None
+		self.dones = None
+		self.version = 0  # version of the policy the actions were chosen with
+		self.steps = steps
+		self.env_count = env_count
+
+
+class Learner:
+	def __init__(self,
+		model: OnPolicyAlgorithm, environment_options: dict,
+		address: tuple[str, int] = default_address, authkey: bytes = None,
+		max_staleness: int = 4, queue_size: int = 8
+	):
+		"""
+		Trains a PPO model on rollouts collected by actors (`run_actor`), which may run in other
+		processes or on other machines. Actors connect through a `multiprocessing` listener on
+		`address`, receive the environment options & the current policy, then keep sending
+		rollouts. Every answer to a rollout carries the newest policy, so actors never wait for
+		the policy update. The rollouts are chosen by a policy that may be a few updates old,
+		the clipped probability ratio of PPO keeps these updates stable as long as the policy
+		is not too far behind.
+
+		:param model: Model to train, its environment only sets the number of environments each
+			actor simulates & its `n_steps` the length of each rollout.
+		:param environment_options: Keyword arguments of `ViennaEnv` sent to the actors.
+		:param address: Host & port to listen on, use '0.0.0.0' as the host to accept actors
+			from other machines.
+		:param authkey: Shared secret the actors have to know. Messages are pickled, so anyone
+			knowing it can run code on the learner & the actors. Required unless `address` is a
+			loopback address, where a random key is generated.
+		:param max_staleness: Rollouts of policies more than this many updates behind are
+			dropped.
+		:param queue_size: Rollouts waiting for the learner, actors are slowed down beyond that.
+		"""
+		self.model = model
+		self.environment_options = environment_options
+		self.max_staleness = max_staleness
+		self.rollouts = queue.Queue(queue_size)
+
+		self.version = 0
+		self.parameters = self.pack_parameters()  # pickled once per version for every actor
+		self.lock = threading.Lock()
+		self.stopping = threading.Event()
+
+		self.actor_count = 0
+		self.dropped = 0
+		self.staleness = []
+
+		if authkey is None:
+			if not is_loopback(address[0]):
+				raise ValueError(f'An authkey is required to listen on {address[0]}.')
+			authkey = secrets.token_hex(16).encode()
+		self.authkey = authkey
+		self.listener = Listener(address, authkey=authkey)
+		threading.Thread(target=self.accept, daemon=True).start()
+
+	@property
+	def address(self) -> tuple[str, int]:
+		return self.listener.address
+
+	def pack_parameters(self) -> bytes:
+		return pickle.dumps(
+			{key: value.cpu() for key, value in self.model.policy.state_dict().items()},
+			protocol=pickle.HIGHEST_PROTOCOL
+		)
+
+	def accept(self):
+		"""
+		Accepts actors until the listener is closed, each is served on its own thread.
+		"""
+		while not self.stopping.is_set():
+			try:
+				connection = self.listener.accept()
+			except (OSError, EOFError, AuthenticationError):
+				continue  # closed by `close` or a failed authentication
+			threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+	def serve(self, connection: Connection):
+		"""
+		Answers one actor: its configuration at first, the newest policy for every rollout.
+		"""
+		with self.lock:
+			actor_id = self.actor_count
+			self.actor_count += 1
+
+		try:
+			receive(connection)  # hello
+			with self.lock:
+				version, parameters = self.version, self.parameters
+			send(connection, {
+				'actor_id': actor_id,
+				'environment_options': self.environment_options,
+				'env_count': self.model.n_envs,
+				'steps': self.model.n_steps,
+				'algorithm': type(self.model),
+				'policy': self.model.policy_class,
+				'policy_kwargs': self.model.policy_kwargs,
+				'version': version,
+			})
+			connection.send_bytes(parameters)
+
+			while not self.stopping.is_set():
+				rollout = receive(connection)
+				while not self.stopping.is_set():
+					try:
+						self.rollouts.put(rollout, timeout=.5)
+						break
+					except queue.Full:
+						pass
+
+				with self.lock:
+					version, parameters = self.version, self.parameters
+				if self.stopping.is_set():
+					send(connection, ('stop', version))
+				elif version == rollout.version:
+					send(connection, ('keep', version))
+				else:
+					send(connection, ('update', version))
+					connection.send_bytes(parameters)
+		except (EOFError, OSError):
+			pass  # the actor is gone
+		finally:
+			connection.close()
+
+	def learn(self,
+		total_timesteps: int, callback: MaybeCallback = None, log_interval: int = 1
+	) -> OnPolicyAlgorithm:
+		"""
+		Trains on the rollouts of the actors until `total_timesteps` environment steps were used,
+		logging like `OnPolicyAlgorithm.learn`.
+
+		:param callback: Called like during `OnPolicyAlgorithm.learn`, but with one step per
+			rollout, where the infos hold the finished episodes. The rollout phase is the time
+			spent waiting for the actors.
+		"""
+		model = self.model
+		total_timesteps, callback = model._setup_learn(total_timesteps, callback)
+		callback.on_training_start(locals(), globals())
+		iteration = 0
+		wait_time = train_time = 0.
+
+		while model.num_timesteps < total_timesteps:
+			callback.on_rollout_start()
+			start = time.perf_counter()
+			rollout = self.rollouts.get()
+			wait_time += time.perf_counter() - start
+
+			staleness = self.version - rollout.version
+			if staleness > self.max_staleness:
+				self.dropped += 1
+				continue
+			self.staleness.append(staleness)
+
+			self.fill_buffer(rollout)
+			model.num_timesteps += rollout.steps * rollout.env_count
+			model._update_info_buffer(rollout.episodes)
+			callback.update_locals({'infos': rollout.episodes})
+			if not callback.on_step():
+				break
+			callback.on_rollout_end()
+			iteration += 1
+			model._update_current_progress_remaining(model.num_timesteps, total_timesteps)
+
+			if log_interval is not None and iteration % log_interval == 0:
+				self.log(iteration, wait_time, train_time)
+				wait_time = train_time = 0.
+
+			start = time.perf_counter()
+			model.train()
+			train_time += time.perf_counter() - start
+
+			parameters = self.pack_parameters()
+			with self.lock:
+				self.version += 1
+				self.parameters = parameters
+
+		callback.on_training_end()
+		return model
+
+	def fill_buffer(self, rollout: Rollout):
+		"""
+		Hands a rollout to the rollout buffer of the model, which computes the advantages.
+		"""
+		buffer = self.model.rollout_buffer
+		buffer.reset()
+		for step in range(rollout.steps):
+			buffer.add(
+				rollout.observations[step], rollout.actions[step], rollout.rewards[step],
+				rollout.episode_starts[step],
+				th.as_tensor(rollout.values[step]), th.as_tensor(rollout.log_probs[step])
+			)
+		buffer.compute_returns_and_advantage(th.as_tensor(rollout.last_values), rollout.dones)
+
+	def log(self, iteration: int, wait_time: float, train_time: float):
+		model = self.model
+		time_elapsed = max((time.time_ns() - model.start_time) / 1e9, sys.float_info.epsilon)
+		model.logger.record('time/iterations', iteration, exclude='tensorboard')
+		if len(model.ep_info_buffer) > 0:
+			model.logger.record(
+				'rollout/ep_rew_mean', safe_mean([info['r'] for info in model.ep_info_buffer])
+			)
+			model.logger.record(
+				'rollout/ep_len_mean', safe_mean([info['l'] for info in model.ep_info_buffer])
+			)
+		model.logger.record(
+			'time/fps', int((model.num_timesteps - model._num_timesteps_at_start) / time_elapsed)
+		)
+		model.logger.record('time/time_elapsed', int(time_elapsed), exclude='tensorboard')
+		model.logger.record('time/total_timesteps', model.num_timesteps, exclude='tensorboard')
+		model.logger.record('distributed/actors', self.actor_count)
+		model.logger.record('distributed/staleness_mean', safe_mean(self.staleness))
+		model.logger.record('distributed/dropped', self.dropped)
+		model.logger.record('distributed/wait_seconds', wait_time)
+		model.logger.record('distributed/train_seconds', train_time)
+		model.logger.dump(step=model.num_timesteps)
+		self.staleness = []
+
+	def close(self):
+		"""
+		Tells every actor to stop with its next rollout & stops listening.
+		"""
+		self.stopping.set()
+		self.listener.close()
+
+
+def run_actor(
+	address: tuple[str, int], authkey: bytes, retry_seconds: float = 30.
+):
+	"""
+	Collects rollouts for a `Learner` until it stops. The environments & the policy are created
+	from the configuration sent by the learner, so an actor only needs to know where it is.
+
+	:param retry_seconds: How long to keep trying to connect, the learner may still be starting.
+	"""
+	deadline = time.time() + retry_seconds
+	while True:
+		try:
+			connection = Client(address, authkey=authkey)
+			break
+		except ConnectionRefusedError:
+			if time.time() > deadline:
+				raise
+			time.sleep(.5)
+
+	try:
+		send(connection, 'hello')
+		config = receive(connection)
+		parameters = pickle.loads(connection.recv_bytes())
+	except EOFError:
+		connection.close()
+		return  # the learner already finished
+
+	vec_env = make_vec_env(
+		ViennaEnv, n_envs=config['env_count'], env_kwargs=config['environment_options']
+	)
+	model = config['algorithm'](
+		config['policy'], vec_env, n_steps=config['steps'], policy_kwargs=config['policy_kwargs'],
+		device='cpu'
+	)
+	policy = model.policy
+	policy.load_state_dict(parameters)
+	policy.set_training_mode(False)
+	version = config['version']
+
+	observations = vec_env.reset()
+	episode_starts = np.ones(vec_env.num_envs, dtype=bool)
+
+	try:
+		while True:
+			rollout = Rollout(config['steps'], vec_env.num_envs)
+			rollout.version = version
+			for _ in range(config['steps']):
+				with th.no_grad():
+					actions, values, log_probs = policy(obs_as_tensor(observations, policy.device))
+				actions = actions.numpy()
+				new_observations, rewards, dones, infos = vec_env.step(actions)
+
+				rollout.observations.append(observations)
+				rollout.actions.append(actions)
+				rollout.rewards.append(rewards)
+				rollout.episode_starts.append(episode_starts)
+				rollout.values.append(values.numpy())
+				rollout.log_probs.append(log_probs.numpy())
+				rollout.episodes += [
+					{'episode': info['episode']} for info in infos if 'episode' in info
+				]
+				observations, episode_starts = new_observations, dones
+
+			with th.no_grad():
+				rollout.last_values = policy.predict_values(
+					obs_as_tensor(observations, policy.device)
+				).numpy()
+			rollout.dones = episode_starts
+
+			send(connection, rollout)
+			answer, version = receive(connection)
+			if answer == 'stop':
+				break
+			if answer == 'update':
+				policy.load_state_dict(pickle.loads(connection.recv_bytes()))
+	except (EOFError, OSError):
+		pass  # the learner is gone
+	finally:
+		connection.close()
+		vec_env.close()
+
+
+def start_local_actors(
+	count: int, address: tuple[str, int], authkey: bytes
+) -> list[mp.Process]:
+	"""
+	Starts actors in processes on this machine, which connect to the learner through
+	`address`, like actors on other machines would.
+	"""
+	context = mp.get_context('spawn')  # torch does not support forking after it was used
+	actors = [
+		context.Process(target=run_actor, args=(address, authkey), daemon=True)
+		for _ in range(count)
+	]
+	for actor in actors:
+		actor.start()
+	return actors
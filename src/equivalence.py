@@ -0,0 +1,531 @@
+from typing import Any, Callable, Mapping, NamedTuple
+import argparse
+import numpy as np
+from ViennaEnv import ViennaEnv
+from VectorViennaEnv import VectorViennaEnv
+from recorder import TraceRecorder
+
+# (place_count, vehicle_count, package_count) checked by default, from the smallest possible
+# environment up to more vehicles than packages & the full set of places
+default_configs = (
+	(2, 1, 1), (4, 3, 2), (5, 1, 2), (6, 4, 3), (10, 3, 5), (10, 8, 5), (12, 11, 6),
+	(20, 5, 10), (40, 1, 20), (80, 10, 20), (80, 30, 40),
+)
+
+
+
+class ReferenceEnv(ViennaEnv):
+	"""
+	`ViennaEnv` stepped by a frozen copy of the original loops of `step` & `automate_packages`,
+	which every candidate is checked against. Only the timestep itself is frozen, the reset,
+	observations & info come from `ViennaEnv`. Idle time is skipped by stepping with no dispatch
+	one timestep at a time, which is what skipping is defined by. Do not optimize this class, it
+	is meant to stay as slow & as obviously correct as the environment it was copied from.
+	"""
+
+	def tick(self, action: np.array):
+		self.clock += 1
+
+		for v, vehicle_decision in enumerate(action, start=1):
+			# helper functions to shorten navigation of the object environment dictionary
+			def vehi(key): return self.environment[key][v]
+			def vehi_set(key, val): self.environment[key][v] = val
+
+			if vehi('v_transit_remaining') == 0:
+				if vehi('v_available'):
+					# dispatch to location 0 means no dispatch
+					if vehicle_decision != 0:
+						vehi_set('v_available', False)
+						vehi_set('v_transit_end', vehicle_decision)
+						vehi_set(
+							'v_transit_remaining',
+							self.distance_matrix[vehi('v_transit_start')][vehicle_decision]
+						)
+				else:
+					vehi_set('v_transit_start', vehi('v_transit_end'))
+					vehi_set('v_available', True)
+
+		# progress each vehicle
+		for v in range(self.vehicle_count):
+			if self.environment['v_transit_remaining'][v] > 0:
+				self.environment['v_transit_remaining'][v] -= 1
+				self.total_travel += 1
+
+		return self.automate_packages()
+
+	def automate_packages(self):
+		package_event = False
+
+		for p in range(1, self.package_count):
+
+			# helper functions to shorten navigation of the object environment dictionary
+			def pack(key): return self.environment[key][p]
+			def pack_set(key, val): self.environment[key][p] = val
+
+			# if a package is already delivered, there are no operations to be done
+			if pack('p_delivered'): continue
+
+			# if a package is on a vehicle, make sure its location is up to date
+			if (
+				pack('p_carrying_vehicle') != 0 and
+				pack('p_location_current') != (updated_location :=
+					self.environment['v_transit_start'][pack('p_carrying_vehicle')]
+				)
+			):
+				pack_set('p_location_current', updated_location)
+
+				# update the total travel time of a package
+				self.ratio_actual[p] += 1
+
+			# for any undelivered package currently not on a vehicle,
+			# make sure any empty vehicles fulfill the request
+			if pack('p_carrying_vehicle') == 0:
+				for v in range(1, self.vehicle_count):
+					def vehi(key): return self.environment[key][v]
+					def vehi_set(key, val): self.environment[key][v] = val
+
+					# if an empty vehicle passes by, pick up the package
+					if (
+						vehi('v_has_package') == 0 and
+						vehi('v_transit_end') == pack('p_location_current') and
+						vehi('v_transit_remaining') == 0  # vehicle is not moving
+					):
+						vehi_set('v_has_package', p)
+						pack_set('p_carrying_vehicle', v)
+						package_event = True
+
+			# if a package is not delivered but on a vehicle, check if it has been delivered
+			else:
+				def vehi(key):
+					return self.environment[key][pack('p_carrying_vehicle')]
+				def vehi_set(key, val):
+					self.environment[key][pack('p_carrying_vehicle')] = val
+
+				# check if package could be delivered
+				if (
+					vehi('v_transit_end') == pack('p_location_target') and
+					vehi('v_transit_remaining') == 0
+				):
+					vehi_set('v_has_package', 0)
+					pack_set('p_location_current', pack('p_location_target'))
+					pack_set('p_carrying_vehicle', 0)
+					pack_set('p_delivered', True)
+					pack_set('p_transit_extra', self.ratio_ideal[p] / self.ratio_actual[p])
+					package_event = True
+
+		# scalars that `ViennaEnv` keeps next to the environment dictionary
+		if package_event:
+			self.last_package_event = self.clock
+		self.undelivered_count = int(np.count_nonzero(~self.environment['p_delivered']))
+		self.transit_extra_total = self.environment['p_transit_extra'].sum()
+		# read by `ViennaEnv.action_masks`
+		waiting = ~self.environment['p_delivered'] & (self.environment['p_carrying_vehicle'] == 0)
+		self.waiting_at[:] = 0
+		self.waiting_at[self.environment['p_location_current'][waiting]] = np.flatnonzero(waiting)
+
+		return self.transit_extra_total
+
+	def skip_idle_ticks(self):
+		reward = 0
+		no_dispatch = np.zeros(self.vehicle_count - 1, dtype=int)
+
+		while (
+			self.vehicle_count > 1 and
+			self.last_package_event != self.clock and
+			not all(self.environment['p_delivered']) and
+			not np.any(
+				self.environment['v_available'][1:] &
+				(self.environment['v_transit_remaining'][1:] == 0)
+			)
+		):
+			reward += self.tick(no_dispatch)
+
+		return reward
+
+
+class VectorRow:
+	def __init__(self, **options):
+		"""
+		Presents the 1st environment of a `VectorViennaEnv` with a single environment like a
+		`ViennaEnv`, so the batched rules can be checked against the reference. The batched
+		environment draws its starting positions from a different generator, so on `reset` the
+		starting state of a `ViennaEnv` reset with the same seed is loaded into it instead.
+
+		Only the clock & total travel time are in the batched info, which matches the reference
+		with `info_level='minimal'`.
+
+		:param options: Keyword arguments of `ViennaEnv`.
+		"""
+		self.start = ViennaEnv(**options)
+		self.venv = VectorViennaEnv(1, **options)
+		self.observation_mode = self.venv.observation_mode
+
+		self.clock = 0
+		self.total_travel = 0
+		self.last_package_event = 0  # not tracked by the batched environment, see `step`
+		self.undelivered_count = 0
+
+	def reset(self, seed: int = None) -> tuple[Any, dict]:
+		self.start.reset(seed=seed)
+		self.venv.reset(seed=seed)
+		self.venv.load_environment(0, self.start)
+
+		self.read_scalars()
+		self.last_package_event = 0
+		return self.row(self.venv.get_observation()), {
+			'clock': self.clock, 'total_travel': self.total_travel
+		}
+
+	def step(self, action: np.array) -> tuple[Any, np.int64, bool, bool, dict]:
+		carrying_vehicle = self.venv.environment['p_carrying_vehicle'][0].copy()
+		observations, rewards, terminated, truncated, info = self.venv.step(action[None])
+
+		if terminated[0]:
+			# the batched environment was reset right away, its final values are in the info
+			observation = info['final_observation'][0]
+			final_info = info['final_info'][0]
+			self.clock = int(final_info['time'])
+			self.total_travel = int(final_info['total_travel'])
+			self.undelivered_count = 0
+			# every package was delivered, the last one in this step
+			self.last_package_event = self.clock
+		else:
+			observation = self.row(observations)
+			self.read_scalars()
+			# every pickup & delivery changes the carrying vehicle of a package
+			if not np.array_equal(
+				carrying_vehicle, self.venv.environment['p_carrying_vehicle'][0]
+			):
+				self.last_package_event = self.clock
+
+		return (
+			observation, rewards[0], bool(terminated[0]), bool(truncated[0]),
+			{'time': self.clock, 'total_travel': self.total_travel}
+		)
+
+	def read_scalars(self):
+		"""
+		Copies the scalars of the 1st batched environment into the attributes of the same name
+		in `ViennaEnv`.
+		"""
+		self.clock = int(self.venv.clock[0])
+		self.total_travel = int(self.venv.total_travel[0])
+		self.undelivered_count = int(self.venv.undelivered_count[0])
+
+	def row(self, observations: dict[str, np.ndarray] | np.ndarray) -> Any:
+		"""
+		:return: Observation of the 1st batched environment.
+		"""
+		if self.observation_mode == 'flat':
+			return observations[0]
+		return {key: value[0] for key, value in observations.items()}
+
+
+def recording(**options) -> ViennaEnv:
+	"""
+	Creates a `ViennaEnv` that records its events from the 1st step on, which makes the kernel
+	report them.
+	"""
+	env = ViennaEnv(**options, recorder=TraceRecorder(), verbose_trigger=-1)
+	env.tracing = True
+	return env
+
+
+# candidate backends, each creates an environment from the reference keyword arguments
+candidates: dict[str, Callable[..., ViennaEnv]] = {
+	'numpy': ViennaEnv,
+	'numba': lambda **options: ViennaEnv(**options, backend='numba'),
+	'recording': recording,
+	'native': VectorRow,
+}
+
+# reference keyword arguments required by a candidate, see `VectorRow`
+candidate_options: dict[str, dict[str, Any]] = {
+	'native': dict(info_level='minimal'),
+}
+
+# chooses the next action from the reference environment, its last observation & a generator
+ActionSource = Callable[[ViennaEnv, Any, np.random.Generator], np.array]
+
+
+def random_actions(env: ViennaEnv, observation: Any, rng: np.random.Generator) -> np.array:
+	"""
+	Sends every vehicle to a random place, including place 0 (no dispatch).
+	"""
+	return rng.integers(0, env.place_count, env.vehicle_count - 1)
+
+
+def sparse_actions(env: ViennaEnv, observation: Any, rng: np.random.Generator) -> np.array:
+	"""
+	Like `random_actions`, but only about every 3rd vehicle is dispatched, so that vehicles
+	also wait at places.
+	"""
+	return random_actions(env, observation, rng) * (rng.random(env.vehicle_count - 1) < .3)
+
+
+def masked_actions(env: ViennaEnv, observation: Any, rng: np.random.Generator) -> np.array:
+	"""
+	Picks a random place among the ones allowed by `ViennaEnv.action_masks`, which gets far more
+	packages delivered than random dispatching.
+	"""
+	masks = env.action_masks().reshape(env.vehicle_count - 1, env.place_count)
+	return np.array([rng.choice(np.flatnonzero(mask)) for mask in masks])
+
+
+def policy_actions(model) -> ActionSource:
+	"""
+	:param model: Trained SB3 model matching the observation mode of the environments.
+	:return: Action source that asks the model for a deterministic prediction.
+	"""
+	def predict(env: ViennaEnv, observation: Any, rng: np.random.Generator) -> np.array:
+		return model.predict(observation, deterministic=True)[0]
+	return predict
+
+
+action_sources: dict[str, ActionSource] = {
+	'random': random_actions,
+	'sparse': sparse_actions,
+	'masked': masked_actions,
+}
+
+
+class Divergence(NamedTuple):
+	"""
+	First difference between the reference & a candidate, along with everything needed to
+	reproduce it with `replay`.
+	"""
+	options: dict[str, Any]
+	seed: int
+	actions: list[np.array]
+	step: int  # index of the action after which they differ, -1 for the reset
+	field: str  # path of the differing value, e.g. 'observation/v_has_package'
+	reference: Any
+	candidate: Any
+
+	def __str__(self) -> str:
+		dispatches = {
+			step: action.tolist() for step, action in enumerate(self.actions) if action.any()
+		}
+		return (
+			f'divergence after step {self.step} in {self.field}'
+			f'\n\toptions:   {self.options}'
+			f'\n\tseed:      {self.seed}'
+			f'\n\treference: {self.reference}'
+			f'\n\tcandidate: {self.candidate}'
+			f'\n\t{len(self.actions)} actions, all zero except {dispatches}'
+		)
+
+
+def first_difference(reference: Any, candidate: Any, path: str) -> tuple[str, Any, Any] | None:
+	"""
+	Compares two outputs of the environments exactly, including the types of scalars like the
+	reward. Mappings such as the lazy info are compared key by key, reading every lazy value.
+
+	:return: Path, reference value & candidate value of the 1st difference, `None` if equal.
+	"""
+	if isinstance(reference, Mapping) or isinstance(candidate, Mapping):
+		if not (isinstance(reference, Mapping) and isinstance(candidate, Mapping)):
+			return path, type(reference), type(candidate)
+		if list(reference) != list(candidate):
+			return f'{path} keys', list(reference), list(candidate)
+		for key in reference:
+			difference = first_difference(reference[key], candidate[key], f'{path}/{key}')
+			if difference is not None:
+				return difference
+		return None
+
+	if isinstance(reference, np.ndarray) or isinstance(candidate, np.ndarray):
+		if (
+			not isinstance(candidate, np.ndarray) or not isinstance(reference, np.ndarray) or
+			reference.dtype != candidate.dtype or not np.array_equal(reference, candidate)
+		):
+			return path, reference, candidate
+		return None
+
+	if type(reference) is not type(candidate) or reference != candidate:
+		return path, reference, candidate
+	return None
+
+
+def compare_envs(
+	reference_env: ViennaEnv, candidate_env: ViennaEnv, reference: tuple, candidate: tuple,
+	names: tuple[str, ...]
+) -> tuple[str, Any, Any] | None:
+	"""
+	Compares the outputs of `reset` or `step` along with the scalars that are not part of them.
+	"""
+	for name, reference_value, candidate_value in zip(names, reference, candidate):
+		difference = first_difference(reference_value, candidate_value, name)
+		if difference is not None:
+			return difference
+
+	for name in ('clock', 'total_travel', 'last_package_event', 'undelivered_count'):
+		difference = first_difference(
+			getattr(reference_env, name), getattr(candidate_env, name), name
+		)
+		if difference is not None:
+			return difference
+
+	return None
+
+
+def replay(
+	candidate: Callable[..., ViennaEnv], options: dict[str, Any], seed: int,
+	actions: list[np.array]
+) -> Divergence | None:
+	"""
+	Steps a reference & a candidate environment through the same fixed actions.
+
+	:param candidate: Creates the candidate environment from `options`.
+	:param options: Keyword arguments of `ViennaEnv`.
+	:return: The 1st divergence, `None` if both behave the same.
+	"""
+	reference_env, candidate_env = ReferenceEnv(**options), candidate(**options)
+
+	difference = compare_envs(
+		reference_env, candidate_env,
+		reference_env.reset(seed=seed), candidate_env.reset(seed=seed),
+		('observation', 'info')
+	)
+	if difference is not None:
+		return Divergence(options, seed, [], -1, *difference)
+
+	for step, action in enumerate(actions):
+		reference = reference_env.step(action.copy())
+		difference = compare_envs(
+			reference_env, candidate_env, reference, candidate_env.step(action.copy()),
+			('observation', 'reward', 'terminated', 'truncated', 'info')
+		)
+		if difference is not None:
+			return Divergence(options, seed, actions[:step+1], step, *difference)
+		if reference[2]:
+			break
+
+	return None
+
+
+def shrink(
+	candidate: Callable[..., ViennaEnv], divergence: Divergence, budget: int = 500
+) -> Divergence:
+	"""
+	Looks for a shorter trajectory with fewer dispatches that still diverges. Whole actions &
+	then single dispatches are replaced with 0 (no dispatch), from the last step to the 1st,
+	keeping every replacement after which the environments still differ.
+
+	:param budget: Highest number of replays to try.
+	:return: Smallest divergence found.
+	"""
+	for per_vehicle in (False, True):
+		for step in reversed(range(len(divergence.actions))):
+			vehicles = np.flatnonzero(divergence.actions[step]) if per_vehicle else [None]
+			for vehicle in vehicles:
+				if budget == 0 or step >= len(divergence.actions):
+					return divergence
+				budget -= 1
+
+				actions = [action.copy() for action in divergence.actions]
+				if vehicle is None:
+					actions[step][:] = 0
+				else:
+					actions[step][vehicle] = 0
+				if np.array_equal(actions[step], divergence.actions[step]):
+					continue
+
+				smaller = replay(candidate, divergence.options, divergence.seed, actions)
+				if smaller is not None:
+					divergence = smaller
+
+	return divergence
+
+
+def check(
+	candidate: Callable[..., ViennaEnv], options: dict[str, Any], seed: int,
+	action_source: ActionSource = random_actions, steps: int = 300
+) -> tuple[Divergence | None, int]:
+	"""
+	Runs the reference with actions from `action_source` & the candidate with the same actions.
+	A divergence is shrunk to a minimal reproducing trajectory.
+
+	:return: The divergence or `None`, & the number of steps compared.
+	"""
+	rng = np.random.default_rng(seed)
+	reference_env = ReferenceEnv(**options)
+	observation, _ = reference_env.reset(seed=seed)
+
+	actions = []
+	for _ in range(steps):
+		actions.append(np.asarray(action_source(reference_env, observation, rng)))
+		observation, _, terminated, _, _ = reference_env.step(actions[-1].copy())
+		if terminated:
+			break
+
+	divergence = replay(candidate, options, seed, actions)
+	if divergence is not None:
+		return shrink(candidate, divergence), divergence.step + 1
+
+	return None, len(actions)
+
+
+def run_harness(
+	candidate: Callable[..., ViennaEnv],
+	configs: tuple[tuple[int, int, int], ...] = default_configs,
+	seeds: int = 4, steps: int = 300,
+	sources: tuple[str, ...] = ('random', 'sparse', 'masked'),
+	**options
+) -> list[Divergence]:
+	"""
+	Checks a candidate against the reference for every configuration, seed & action source.
+
+	:param configs: (place_count, vehicle_count, package_count) of each environment.
+	:param options: Further keyword arguments of `ViennaEnv`, like the observation mode.
+	:return: Every divergence found, each shrunk to a minimal trajectory.
+	"""
+	divergences = []
+	total = 0
+
+	for place_count, vehicle_count, package_count in configs:
+		config = dict(
+			place_count=place_count, vehicle_count=vehicle_count, package_count=package_count,
+			**options
+		)
+		for seed in range(seeds):
+			for source in sources:
+				divergence, compared = check(
+					candidate, config, seed, action_sources[source], steps
+				)
+				total += compared
+				if divergence is not None:
+					print(f'{source} actions: {divergence}')
+					divergences.append(divergence)
+
+	print(f'Compared {total} steps, found {len(divergences)} divergences.')
+	return divergences
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Checks that a faster ViennaEnv backend matches the reference step by step.'
+	)
+	parser.add_argument('candidate', type=str, choices=list(candidates), nargs='?', default='numba')
+	parser.add_argument('--seeds', type=int, default=4)
+	parser.add_argument('--steps', type=int, default=300)
+	parser.add_argument(
+		'--actions', type=str, nargs='+', choices=list(action_sources),
+		default=['random', 'sparse', 'masked']
+	)
+	parser.add_argument(
+		'--observation', type=str, choices=['dict', 'flat', 'graph'], default='dict'
+	)
+	parser.add_argument('--skip_idle_time', action='store_true')
+	arguments = parser.parse_args()
+	if arguments.candidate == 'native' and arguments.skip_idle_time:
+		parser.error('The native vector environment does not skip idle time.')
+
+	found = run_harness(
+		candidates[arguments.candidate],
+		seeds=arguments.seeds, steps=arguments.steps, sources=tuple(arguments.actions),
+		observation_mode=arguments.observation, skip_idle_time=arguments.skip_idle_time,
+		**candidate_options.get(arguments.candidate, {})
+	)
+	if found:
+		raise SystemExit(1)
@@ -0,0 +1,173 @@
+import gymnasium as gym
+import torch as th
+from torch import nn
+from stable_baselines3.common.torch_layers import BaseFeaturesExtractor
+from ViennaEnv import flat_layout
+from distances import get_neighbour_edges
+
+
+class EmbeddingExtractor(BaseFeaturesExtractor):
+	def __init__(self,
+		observation_space: gym.spaces.Box,
+		place_count: int = 80, vehicle_count: int = 10, package_count: int = 20,
+		embedding_dim: int = 8, features_dim: int = 256
+	):
+		"""
+		Features extractor for the 'flat' observation mode of `ViennaEnv`. Instead of one-hot
+		encoding every place, vehicle & package id like `MultiInputPolicy` does, each id is looked
+		up in a learned embedding. Every vehicle & package is turned into one row of its embedded
+		ids & its remaining numbers scaled to `[0, 1]`, all rows are then flattened into a linear
+		layer. Pass it to a policy with `policy_kwargs`, along with the environment options:
+
+		`dict(features_extractor_class=EmbeddingExtractor, features_extractor_kwargs=dict(
+		place_count=80, vehicle_count=10, package_count=20))`
+
+		:param place_count: Same as in `ViennaEnv`.
+		:param vehicle_count: Same as in `ViennaEnv`.
+		:param package_count: Same as in `ViennaEnv`.
+		:param embedding_dim: Size of the place, vehicle & package embeddings.
+		:param features_dim: Number of features returned.
+		"""
+		super().__init__(observation_space, features_dim)
+
+		self.slices = flat_layout(vehicle_count + 1, package_count + 1)
+		assert self.slices['p_transit_extra'].stop == observation_space.shape[0], \
+			'Observation does not match the environment options.'
+
+		# index 0 stands for no place, vehicle or package
+		self.places = nn.Embedding(place_count + 1, embedding_dim)
+		self.vehicles = nn.Embedding(vehicle_count + 1, embedding_dim)
+		self.packages = nn.Embedding(package_count + 1, embedding_dim)
+
+		# largest value of each field, to scale the numbers
+		high = th.as_tensor(observation_space.high, dtype=th.float32).clamp(min=1)
+		self.register_buffer('scale', high)
+
+		vehicle_width = vehicle_count * (3 * embedding_dim + 2)
+		package_width = package_count * (3 * embedding_dim + 2)
+		self.linear = nn.Sequential(
+			nn.Linear(vehicle_width + package_width, features_dim),
+			nn.ReLU(),
+		)
+
+	def forward(self, observations: th.Tensor) -> th.Tensor:
+		# SB3 hands over the observations as floats
+		ids = observations.long()
+		scaled = observations / self.scale
+
+		def field(key: str, embedding: nn.Embedding = None) -> th.Tensor:
+			columns = self.slices[key]
+			if embedding is None:
+				return scaled[:, columns].unsqueeze(-1)
+			return embedding(ids[:, columns])
+
+		vehicles = th.cat((
+			field('v_transit_start', self.places),
+			field('v_transit_end', self.places),
+			field('v_has_package', self.packages),
+			field('v_available'),
+			field('v_transit_remaining'),
+		), dim=-1)
+		packages = th.cat((
+			field('p_location_current', self.places),
+			field('p_location_target', self.places),
+			field('p_carrying_vehicle', self.vehicles),
+			field('p_delivered'),
+			field('p_transit_extra'),
+		), dim=-1)
+
+		return self.linear(th.cat((vehicles.flatten(1), packages.flatten(1)), dim=1))
+
+
+class GraphExtractor(BaseFeaturesExtractor):
+	def __init__(self,
+		observation_space: gym.spaces.Dict,
+		neighbours: int = 8, hidden_dim: int = 32, layers: int = 2, features_dim: int = 256
+	):
+		"""
+		Features extractor for the 'graph' observation mode of `ViennaEnv`. The places are the
+		nodes of a graph, where each place is connected to its nearest places by travel time
+		(`distances.get_neighbour_edges`). The edges never change, so they are built once here
+		instead of being part of every observation. After a few rounds of passing messages along
+		the edges, every vehicle reads the node features of its position & of the target of its
+		package. Pass it to `MultiInputPolicy` with `policy_kwargs`:
+
+		`dict(features_extractor_class=GraphExtractor, features_extractor_kwargs=dict(neighbours=8))`
+
+		:param neighbours: Edges per place.
+		:param hidden_dim: Size of the node features.
+		:param layers: Number of message passing rounds.
+		:param features_dim: Number of features returned.
+		"""
+		super().__init__(observation_space, features_dim)
+
+		places = observation_space['places']
+		vehicles = observation_space['vehicles']
+		place_count, vehicle_count = places.shape[0], vehicles.shape[0]
+
+		edge_index, travel_times = get_neighbour_edges(place_count, neighbours)
+		self.register_buffer('edge_index', th.tensor(edge_index, dtype=th.long))
+		self.register_buffer(
+			'travel_times',
+			th.tensor(travel_times / max(travel_times.max(), 1), dtype=th.float32)[:, None]
+		)
+		self.neighbours = edge_index.shape[1] // place_count
+
+		# largest value of each feature, to scale the numbers
+		self.register_buffer(
+			'place_scale', th.as_tensor(places.high[0], dtype=th.float32).clamp(min=1)
+		)
+		self.register_buffer(
+			'vehicle_scale', th.as_tensor(vehicles.high[0], dtype=th.float32).clamp(min=1)
+		)
+
+		self.encode = nn.Sequential(nn.Linear(places.shape[1], hidden_dim), nn.ReLU())
+		self.layers = nn.ModuleList(NeighbourLayer(hidden_dim) for _ in range(layers))
+		self.linear = nn.Sequential(
+			# every vehicle reads 2 nodes & its dispatchable flag & remaining transit time
+			nn.Linear(vehicle_count * (2 * hidden_dim + 2) + hidden_dim, features_dim),
+			nn.ReLU(),
+		)
+
+	def forward(self, observations: dict[str, th.Tensor]) -> th.Tensor:
+		nodes = self.encode(observations['places'] / self.place_scale)
+		for layer in self.layers:
+			nodes = layer(nodes, self.edge_index, self.travel_times, self.neighbours)
+
+		# places are numbered from 1 in the vehicle features, 0 reads an empty node
+		nodes = th.cat((th.zeros_like(nodes[:, :1]), nodes), dim=1)
+
+		vehicles = observations['vehicles']
+		position = vehicles[..., 0].long()
+		target = vehicles[..., 3].long()
+		rows = th.arange(len(nodes), device=nodes.device)[:, None]
+
+		vehicle_features = th.cat((
+			nodes[rows, position],
+			nodes[rows, target],
+			vehicles[..., 1:3] / self.vehicle_scale[1:3],
+		), dim=-1)
+
+		return self.linear(th.cat((vehicle_features.flatten(1), nodes[:, 1:].mean(1)), dim=1))
+
+
+class NeighbourLayer(nn.Module):
+	def __init__(self, dim: int):
+		"""
+		One round of message passing for `GraphExtractor`, every node averages the messages of
+		its neighbours, which depend on the neighbour & the travel time between them.
+		"""
+		super().__init__()
+		self.message = nn.Linear(dim + 1, dim)
+		self.update = nn.Linear(2 * dim, dim)
+
+	def forward(self,
+		nodes: th.Tensor, edge_index: th.Tensor, travel_times: th.Tensor, neighbours: int
+	) -> th.Tensor:
+		sources, targets = edge_index
+		messages = self.message(th.cat((
+			nodes[:, sources], travel_times.expand(len(nodes), -1, -1)
+		), dim=-1))
+		received = th.zeros_like(nodes).index_add_(1, targets, messages) / neighbours
+
+		return th.relu(self.update(th.cat((nodes, received), dim=-1)))
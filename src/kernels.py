@@ -0,0 +1,170 @@
+from typing import Callable
+import numpy as np
+from recorder import DISPATCH, ARRIVAL, PICKUP, DELIVERY
+
+# `tick_kernel` compiled by numba, created by the 1st call of `load_compiled_tick`
+_compiled_tick: Callable | None = None
+
+
+def tick_kernel(
+	action: np.array, distance_matrix: np.array,
+	v_available: np.array, v_transit_start: np.array, v_transit_end: np.array,
+	v_transit_remaining: np.array, v_has_package: np.array,
+	p_location_current: np.array, p_location_target: np.array, p_carrying_vehicle: np.array,
+	p_delivered: np.array, p_transit_extra: np.array,
+	ratio_ideal: np.array, ratio_actual: np.array,
+	waiting_at: np.array, stopped: np.array, events: np.array
+) -> tuple[int, int, int, int, int]:
+	"""
+	One timestep of `ViennaEnv.tick` as plain loops over the environment arrays, which are
+	updated in place. Vehicles are dispatched & progressed in order, then every vehicle that
+	stopped during this timestep delivers its package or picks up the package waiting at its
+	location. The numba backend compiles this in `load_compiled_tick`, the numpy backend runs it
+	as it is. Every element is read through `int`, as comparing a single element of a small
+	integer array with a Python integer takes microseconds in numpy, while the conversion is
+	free once compiled.
+
+	The original implementation checked every package against every vehicle in each timestep.
+	Only stopped vehicles need to be looked at: packages wait at their origin until picked up &
+	are only dropped at their target, the origins & targets of an episode are distinct places &
+	a vehicle picks up or delivers right when it stops. So at most one package waits at any
+	place, & a vehicle that stopped earlier has nothing left to do where it stands. Every empty
+	vehicle stopping at the place of a waiting package picks it up, while the package records
+	the highest of them as its carrying vehicle, as before.
+
+	:param waiting_at: Package waiting at every place, 0 if none. Kept up to date here.
+	:param stopped: Scratch space with a slot for every vehicle.
+	:param events: Filled with a row of kind, vehicle, package & place for every dispatch,
+		arrival, pickup & delivery, see `recorder.event_kinds`. Needs `event_capacity` rows,
+		nothing is written if it has none.
+	:return: Number of vehicles that moved, number of packages delivered, sum of the
+		`p_transit_extra` of the delivered packages, number of pickups & number of events.
+	"""
+	recording = len(events) != 0
+	count = 0
+	stopped_count = 0
+
+	for i in range(len(action)):
+		v = i + 1
+		if int(v_transit_remaining[v]) == 0:
+			if v_available[v]:
+				# dispatch to location 0 means no dispatch
+				place = int(action[i])
+				if place != 0:
+					v_available[v] = False
+					v_transit_end[v] = place
+					v_transit_remaining[v] = distance_matrix[int(v_transit_start[v]), place]
+					if recording:
+						events[count, 0] = DISPATCH
+						events[count, 1] = v
+						events[count, 2] = v_has_package[v]
+						events[count, 3] = place
+						count += 1
+					# a vehicle dispatched to its own location stops there right away
+					if int(v_transit_remaining[v]) == 0:
+						stopped[stopped_count] = v
+						stopped_count += 1
+						if recording:
+							events[count] = events[count - 1]
+							events[count, 0] = ARRIVAL
+							count += 1
+			else:
+				v_transit_start[v] = v_transit_end[v]
+				v_available[v] = True
+				# the package of a released vehicle moves along to its new location
+				p = int(v_has_package[v])
+				if (
+					p != 0 and int(p_carrying_vehicle[p]) == v and
+					int(p_location_current[p]) != int(v_transit_start[v])
+				):
+					p_location_current[p] = v_transit_start[v]
+					ratio_actual[p] += 1
+
+	moved = 0
+	for v in range(len(v_transit_remaining)):
+		remaining = int(v_transit_remaining[v])
+		if remaining > 0:
+			v_transit_remaining[v] = remaining - 1
+			moved += 1
+			if remaining == 1:
+				stopped[stopped_count] = v
+				stopped_count += 1
+				if recording:
+					events[count, 0] = ARRIVAL
+					events[count, 1] = v
+					events[count, 2] = v_has_package[v]
+					events[count, 3] = v_transit_end[v]
+					count += 1
+
+	delivered = transit_extra = picked_up = 0
+	for i in range(stopped_count):
+		v = int(stopped[i])
+		location = int(v_transit_end[v])
+		p = int(v_has_package[v])
+
+		if p == 0:
+			p = int(waiting_at[location])
+			if p != 0:
+				v_has_package[v] = p
+				# vehicles stopping right after their dispatch come before the arriving ones
+				if v > int(p_carrying_vehicle[p]):
+					p_carrying_vehicle[p] = v
+				picked_up += 1
+				if recording:
+					events[count, 0] = PICKUP
+					events[count, 1] = v
+					events[count, 2] = p
+					events[count, 3] = location
+					count += 1
+
+		# vehicles that still hold a package carried by another one cannot deliver it
+		elif int(p_carrying_vehicle[p]) == v and int(p_location_target[p]) == location:
+			v_has_package[v] = 0
+			p_location_current[p] = location
+			p_carrying_vehicle[p] = 0
+			p_delivered[p] = True
+			# truncated when written, like the numpy assignment
+			p_transit_extra[p] = ratio_ideal[p] / ratio_actual[p]
+			transit_extra += int(p_transit_extra[p])
+			delivered += 1
+			if recording:
+				events[count, 0] = DELIVERY
+				events[count, 1] = v
+				events[count, 2] = p
+				events[count, 3] = location
+				count += 1
+
+	# packages are only taken off the index once every vehicle stopping there picked them up
+	if picked_up:
+		for i in range(stopped_count):
+			location = int(v_transit_end[int(stopped[i])])
+			p = int(waiting_at[location])
+			if p != 0 and int(p_carrying_vehicle[p]) != 0:
+				waiting_at[location] = 0
+
+	return moved, delivered, transit_extra, picked_up, count
+
+
+def event_capacity(vehicle_count: int, package_count: int) -> int:
+	"""
+	:return: Highest number of events of a single timestep, with every vehicle dispatched,
+		arriving & picking up a package & every package being delivered.
+	"""
+	return 3 * (vehicle_count - 1) + package_count - 1
+
+
+def load_compiled_tick() -> Callable | None:
+	"""
+	Imports numba & compiles `tick_kernel` the 1st time it is called, so that environments
+	using the numpy backend start without importing numba.
+
+	:return: The compiled kernel, `None` if numba is not installed.
+	"""
+	global _compiled_tick
+	if _compiled_tick is None:
+		try:
+			from numba import njit
+		except ImportError:
+			return None  # the compiled backend of `ViennaEnv` falls back to numpy
+		_compiled_tick = njit(cache=True)(tick_kernel)
+	return _compiled_tick
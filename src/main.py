@@ -1,7 +1,15 @@
 from stable_baselines3 import PPO
 from stable_baselines3.common.base_class import SelfBaseAlgorithm
 from stable_baselines3.common.env_util import make_vec_env
+from stable_baselines3.common.callbacks import CallbackList
+from stable_baselines3.common.vec_env import VecEnv
 from ViennaEnv import ViennaEnv
+from VectorViennaEnv import ViennaVecEnv
+from recorder import TraceRecorder
+from extractors import EmbeddingExtractor, GraphExtractor
+from callbacks import CheckpointCallback, ProfilingCallback, TelemetryCallback, find_checkpoints
+from parallel import make_parallel_env, start_methods
+from distributed import Learner, is_loopback, parse_address, run_actor, start_local_actors
 import numpy as np
 from visualizer import Visualizer as Vis
 import time
@@ -15,13 +23,18 @@ import os
 model_path = 'models/'
 def find_best_model(
 	desired_model: str,
-	pvp: dict
+	pvp: dict,
+	algorithm: type[SelfBaseAlgorithm] = PPO,
+	prefix: str = 'ppo'
 ) -> tuple[str, SelfBaseAlgorithm]:
 	"""
 	At 1st looks for a model with the exact desired parameters. Otherwise, find a model with the
 	correct 'pvp' parameters with the highest # of simultaneous trained environments. If
 	multiple exists, then use the highest training timestep value. The model name along with the
 	model itself is returned.
+
+	:param algorithm: Class used to load the model, `MaskablePPO` for masked models.
+	:param prefix: Start of the model names to search, see `model_prefix`.
 	"""
 	
 	
@@ -29,12 +42,12 @@ def find_best_model(
 	models_found = os.listdir(model_path)
 	if desired_model in models_found:
 		print(f'Loading model {desired_model}')
-		return desired_model, PPO.load(model_path + desired_model)
+		return desired_model, algorithm.load(model_path + desired_model)
 		
 	else:
 	
 		pattern = re.compile(
-			rf'^ppo_vrp_e(\d+)-t(\d+)_pvp'
+			rf'^{prefix}_vrp_e(\d+)-t(\d+)_pvp'
 			rf'-{pvp["place_count"]}'
 			rf'-{pvp["vehicle_count"]}'
 			rf'-{pvp["package_count"]}\.zip$'
@@ -56,13 +69,46 @@ def find_best_model(
 		assert best_file is not None, 'No model with correct pvp parameters exists.'
 		warn(f'\nLoading best matching model from {best_file}.')
 	
-		return best_file, PPO.load(model_path + best_file)
+		return best_file, algorithm.load(model_path + best_file)
+
+
+def create_vec_env(
+	vec_env_type: str,
+	environment_count: int,
+	environment_options: dict,
+	parallel_options: dict = None
+) -> VecEnv:
+	"""
+	Creates the vectorized environment used for training & testing.
+
+	:param vec_env_type: 'dummy' steps `environment_count` separate `ViennaEnv` objects one
+		after another, while 'native' simulates all of them at once in a `VectorViennaEnv`.
+		'subproc' steps them in worker processes, see `parallel.ParallelVecEnv`.
+	:param parallel_options: Keyword arguments of `parallel.make_parallel_env` for 'subproc'.
+	"""
+	if vec_env_type == 'subproc':
+		return make_parallel_env(environment_count, environment_options, **(parallel_options or {}))
+
+	if vec_env_type == 'native':
+		# the verbose trigger & a recorder are always set, the native environment warns about
+		# the other options it ignores, as well as about traces that were asked for
+		options = dict(environment_options)
+		options.pop('verbose_trigger', None)
+		if options.get('recorder') is not None and options['recorder'].path is None:
+			del options['recorder']
+		return ViennaVecEnv(environment_count, **options)
+
+	return make_vec_env(
+		ViennaEnv,
+		n_envs=environment_count,
+		env_kwargs=environment_options
+	)
 
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('action', type=str, choices=[
-		'train', 'test', 'vis', 'details',
+		'train', 'test', 'vis', 'details', 'learner', 'actor', 'resume',
 	], nargs='?', default='vis')
 	parser.add_argument('environment_count', type=int,  nargs='?', default=10)
 	parser.add_argument('train_time_k',      type=int,  nargs='?', default=1_000)
@@ -72,14 +118,56 @@ if __name__ == '__main__':
 	parser.add_argument('verbose',           type=bool, nargs='?', default=False)
 	parser.add_argument('verbose_trig_k',    type=int,  nargs='?', default=20_000)
 	parser.add_argument('manual_model',      type=str, nargs='?', default=None)
+	parser.add_argument(
+		'--vec_env', type=str, choices=['dummy', 'native', 'subproc'], default='dummy'
+	)
+	parser.add_argument('--workers', type=int, default=None)
+	parser.add_argument('--start_method', type=str, choices=start_methods, default='forkserver')
+	parser.add_argument('--pin_cores', action='store_true')
+	parser.add_argument('--skip_idle_time', action='store_true')
+	parser.add_argument('--trace', action='store_true')
+	parser.add_argument('--maskable', action='store_true')
+	parser.add_argument(
+		'--observation', type=str, choices=['dict', 'flat', 'graph'], default='dict'
+	)
+	parser.add_argument('--neighbours', type=int, default=8)
+	parser.add_argument('--backend', type=str, choices=['numpy', 'numba'], default='numpy')
+	parser.add_argument('--profile', action='store_true')
+	parser.add_argument('--telemetry_interval', type=int, default=10_000)
+	parser.add_argument('--address', type=str, default='localhost:6000')
+	parser.add_argument('--authkey', type=str, default=None)
+	parser.add_argument('--local_actors', type=int, default=0)
+	parser.add_argument('--checkpoint_interval', type=int, default=100_000)
+	parser.add_argument('--checkpoint_keep', type=int, default=3)
 
 	arguments = parser.parse_args()
+	# the learner & actors exchange pickles, which run code for anyone knowing the key
+	if arguments.authkey is None and (
+		arguments.action == 'actor' or
+		arguments.action == 'learner' and not is_loopback(parse_address(arguments.address)[0])
+	):
+		parser.error('--authkey is required for actors & for learners not on a loopback address')
+	authkey = None if arguments.authkey is None else arguments.authkey.encode()
 	environment_options = {
 		'place_count': arguments.place_count,
 		'vehicle_count': arguments.vehicle_count,
 		'package_count': arguments.package_count,
 		'verbose': arguments.verbose,
 		'verbose_trigger': arguments.verbose_trig_k * 1_000,
+		'skip_idle_time': arguments.skip_idle_time,
+		# training does not read the step info, testing only reads the clock & travel time
+		'info_level': {
+			'train': 'none', 'learner': 'none', 'resume': 'none', 'test': 'minimal'
+		}.get(arguments.action, 'full'),
+		'observation_mode': arguments.observation,
+		'backend': arguments.backend,
+		'profile': arguments.profile,
+	}
+	# only used by `--vec_env subproc`
+	parallel_options = {
+		'workers': arguments.workers,
+		'start_method': arguments.start_method,
+		'pin_cores': arguments.pin_cores,
 	}
 	
 	if environment_options['verbose_trigger'] <= arguments.train_time_k * 1_000:
@@ -90,11 +178,42 @@ if __name__ == '__main__':
 
 
 
+	# masked models only choose between dispatches that change something, see
+	# `ViennaEnv.action_masks`. sb3_contrib is only needed when they are used.
+	assert not (arguments.maskable and arguments.action == 'learner'), \
+		'Masked models cannot be trained from actors.'
+	if arguments.maskable:
+		from sb3_contrib import MaskablePPO
+		algorithm, model_prefix = MaskablePPO, 'maskable_ppo'
+	else:
+		algorithm, model_prefix = PPO, 'ppo'
+
+	# flat observations are read through learned embeddings instead of one-hot encodings
+	if arguments.observation == 'flat':
+		policy, model_prefix = 'MlpPolicy', f'{model_prefix}_flat'
+		policy_kwargs = dict(
+			features_extractor_class=EmbeddingExtractor,
+			features_extractor_kwargs=dict(
+				place_count=arguments.place_count,
+				vehicle_count=arguments.vehicle_count,
+				package_count=arguments.package_count,
+			),
+		)
+	# graph observations are read by passing messages between the nearest places
+	elif arguments.observation == 'graph':
+		policy, model_prefix = 'MultiInputPolicy', f'{model_prefix}_graph'
+		policy_kwargs = dict(
+			features_extractor_class=GraphExtractor,
+			features_extractor_kwargs=dict(neighbours=arguments.neighbours),
+		)
+	else:
+		policy, policy_kwargs = 'MultiInputPolicy', None
+
 	# model to write if train is true, model to load if train is false
 	
 	if arguments.manual_model is None:
 		model_name = (
-			f'ppo_vrp_e{arguments.environment_count}-t{arguments.train_time_k}_'
+			f'{model_prefix}_vrp_e{arguments.environment_count}-t{arguments.train_time_k}_'
 			f'pvp'
 			f'-{environment_options["place_count"]}'
 			f'-{environment_options["vehicle_count"]}'
@@ -103,19 +222,77 @@ if __name__ == '__main__':
 	else:
 		model_name = arguments.manual_model
 
+	# once the verbose trigger fires, record events instead of printing them, which would slow
+	# the run down to a crawl. They are kept in memory unless `--trace` writes them to a file,
+	# printing only happens with an explicit `verbose`.
+	recorder = None
+	if arguments.action in ('train', 'resume', 'test', 'learner'):
+		recorder = TraceRecorder(
+			f'{model_path}{model_name}_{arguments.action}_trace.bin'
+			if arguments.trace and arguments.action != 'learner' else None
+		)
+		environment_options['recorder'] = recorder
+
 	match arguments.action:
-		case 'train':
+		case 'actor':
+			# the environment & policy options are sent by the learner
+			print('collecting rollouts...')
+			run_actor(parse_address(arguments.address), authkey)
+
+		case 'train' | 'learner' | 'resume':
 			start_time = time.time()
 			
 			print('training...')
-			vec_env = make_vec_env(
-				ViennaEnv,
-				n_envs=arguments.environment_count,
-				env_kwargs=environment_options
+			# the environments of the learner are never stepped, they only set the actor batch
+			vec_env = create_vec_env(
+				'dummy' if arguments.action == 'learner' else arguments.vec_env,
+				arguments.environment_count, environment_options, parallel_options
 			)
-			model = PPO('MultiInputPolicy', vec_env, verbose=1)
-			model.learn(total_timesteps=arguments.train_time_k * 1_000)
+			if arguments.action == 'resume':
+				# continues with the optimizer state & timestep count of the latest checkpoint
+				checkpoints = find_checkpoints(model_name)
+				assert checkpoints, f'No checkpoint of {model_name} exists.'
+				print(f'resuming from {checkpoints[-1][1]}...')
+				model = algorithm.load(checkpoints[-1][1], env=vec_env)
+			else:
+				model = algorithm(policy, vec_env, policy_kwargs=policy_kwargs, verbose=1)
+			# throughput & episode statistics are appended to a log that tools can parse
+			telemetry = TelemetryCallback(
+				model_path + 'training.jsonl', arguments.telemetry_interval, model_name,
+				env_progress=arguments.action != 'learner'
+			)
+			# written in the background, a crashed run continues from them with resume
+			callbacks = [
+				telemetry,
+				CheckpointCallback(
+					model_name, arguments.checkpoint_interval, arguments.checkpoint_keep
+				),
+			]
+			# environment phase timings are written to the training output
+			if arguments.profile and arguments.action != 'learner':
+				callbacks.append(ProfilingCallback())
+
+			if arguments.action == 'learner':
+				# rollouts are collected by actors, in processes here or on other machines
+				learner = Learner(
+					model, environment_options, parse_address(arguments.address), authkey
+				)
+				if authkey is None:
+					print(f'actors connect with --authkey {learner.authkey.decode()}')
+				start_local_actors(arguments.local_actors, learner.address, learner.authkey)
+				learner.learn(arguments.train_time_k * 1_000, CallbackList(callbacks))
+				learner.close()
+			else:
+				model.learn(
+					total_timesteps=arguments.train_time_k * 1_000 - model.num_timesteps,
+					callback=CallbackList(callbacks),
+					reset_num_timesteps=arguments.action != 'resume'
+				)
 			model.save(model_path + model_name)
+			# also writes the trace events of the workers of `--vec_env subproc`
+			vec_env.close()
+			if recorder is not None:
+				recorder.close()
 			
 			results = (
 				f'\n{model_name}:'
@@ -131,24 +308,39 @@ if __name__ == '__main__':
 			
 			with open(model_path + 'training.log', 'a') as f:
 				f.write(results)
+			telemetry.write({
+				'event': 'summary',
+				'execution_time': time.time() - start_time,
+				'environment_count': arguments.environment_count,
+				'vec_env': 'actors' if arguments.action == 'learner' else arguments.vec_env,
+				'environment_options': {
+					key: value for key, value in environment_options.items() if key != 'recorder'
+				},
+			})
 			
 			print(f'Model saved as {model_name}')
 
 		case 'test':
 			print('testing...')
 			
-			model_name, model = find_best_model(model_name, environment_options)
-			vec_env = make_vec_env(
-				ViennaEnv,
-				n_envs=arguments.environment_count,
-				env_kwargs=environment_options
+			model_name, model = find_best_model(
+				model_name, environment_options, algorithm, model_prefix
+			)
+			vec_env = create_vec_env(
+				arguments.vec_env, arguments.environment_count, environment_options,
+				parallel_options
 			)
 			obs = vec_env.reset()
 			done = [False] * arguments.environment_count
 			previous_reward = 0
 
 			while not all(list(done)):
-				action, _states = model.predict(obs)
+				if arguments.maskable:
+					action, _states = model.predict(
+						obs, action_masks=np.stack(vec_env.env_method('action_masks'))
+					)
+				else:
+					action, _states = model.predict(obs)
 				obs, reward, done, info = vec_env.step(action)
 				# update progress
 				if previous_reward < (current_reward := np.sum(reward)):
@@ -183,6 +375,9 @@ if __name__ == '__main__':
 
 			print(results)
 
+			if recorder is not None:
+				recorder.close()
+
 			with open('testing.log', 'a') as f:
 				f.write(results)
 
@@ -190,7 +385,9 @@ if __name__ == '__main__':
 
 		case 'vis':
 			
-			model_name, model = find_best_model(model_name, environment_options)
+			model_name, model = find_best_model(
+				model_name, environment_options, algorithm, model_prefix
+			)
 	
 			vis = Vis(environment_options)
 			env = ViennaEnv(**environment_options)
@@ -198,7 +395,10 @@ if __name__ == '__main__':
 			done = False
 
 			while not done:
-				action, _states = model.predict(obs)
+				if arguments.maskable:
+					action, _states = model.predict(obs, action_masks=env.action_masks())
+				else:
+					action, _states = model.predict(obs)
 				obs, _, done, _, info = env.step(action)
 
 				vis.draw(info)
@@ -207,7 +407,7 @@ if __name__ == '__main__':
 			input('Press ENTER to exit.')
 
 		case 'details':
-			_, model = find_best_model(model_path, model_name, environment_options)
+			_, model = find_best_model(model_name, environment_options, algorithm, model_prefix)
 			print(model.policy)
 
 		case _:
@@ -0,0 +1,252 @@
+from typing import Any, Callable, Iterable
+from multiprocessing.connection import Connection
+from warnings import warn
+import multiprocessing as mp
+import os
+import cloudpickle
+import gymnasium as gym
+import numpy as np
+from stable_baselines3.common.monitor import Monitor
+from stable_baselines3.common.vec_env import DummyVecEnv, VecEnv
+from distances import share_distance_matrix
+from ViennaEnv import ViennaEnv
+
+start_methods = ('fork', 'forkserver', 'spawn')
+
+
+def worker_loop(
+	remote: Connection, parent_remote: Connection, env_fns: bytes, core: int = None
+):
+	"""
+	Runs in every worker process of `ParallelVecEnv`. The group of environments of the worker is
+	stepped in a `DummyVecEnv`, which also resets finished environments, & every command of the
+	parent is answered through `remote`.
+
+	:param env_fns: Pickled functions creating the environments. They are pickled even when the
+		worker is forked, so that every worker gets its own copy of objects like the recorder.
+	:param core: CPU core to pin the worker to, not pinned if `None`.
+	"""
+	parent_remote.close()
+	if core is not None:
+		os.sched_setaffinity(0, {core})
+
+	envs = DummyVecEnv(cloudpickle.loads(env_fns))
+	try:
+		while True:
+			command, data = remote.recv()
+			match command:
+				case 'step':
+					remote.send(envs.step(data))
+				case 'reset':
+					seeds, options = data
+					# the seeds of a group are consecutive, see `VecEnv.seed`
+					if seeds[0] is not None:
+						envs.seed(seeds[0])
+					envs.set_options(options)
+					remote.send(envs.reset())
+				case 'get_attr':
+					remote.send(envs.get_attr(*data))
+				case 'set_attr':
+					remote.send(envs.set_attr(*data))
+				case 'env_method':
+					name, args, kwargs, indices = data
+					remote.send(envs.env_method(name, *args, indices=indices, **kwargs))
+				case 'env_is_wrapped':
+					remote.send(envs.env_is_wrapped(*data))
+				case 'get_spaces':
+					remote.send((envs.observation_space, envs.action_space))
+				case 'close':
+					envs.close()
+					remote.close()
+					break
+	except (EOFError, KeyboardInterrupt):
+		pass  # the parent is gone
+
+
+class ParallelVecEnv(VecEnv):
+	def __init__(self,
+		env_fns: list[Callable[[], gym.Env]], workers: int = None,
+		start_method: str = 'forkserver', pin_cores: bool = False
+	):
+		"""
+		Steps the environments in worker processes, like `SubprocVecEnv`, but each worker holds a
+		group of environments instead of a single one. This way the number of processes can match
+		the number of cores, while each of them still steps several environments per call.
+
+		:param env_fns: Create the environments, they are split into consecutive groups.
+		:param workers: Number of worker processes, defaults to the number of usable cores. Never
+			more than the number of environments.
+		:param start_method: 'fork', 'forkserver' or 'spawn', see `multiprocessing`. 'forkserver'
+			imports the environment once in the server process, every worker is forked from it.
+		:param pin_cores: Pin every worker to its own core, in order of the usable cores. Only
+			supported on Linux.
+		"""
+		cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+		workers = min(workers or (len(cores) if cores else os.cpu_count()), len(env_fns))
+		if pin_cores and cores is None:
+			warn('Pinning workers to cores is not supported on this system.')
+			pin_cores = False
+
+		context = mp.get_context(start_method)
+		if start_method == 'forkserver':
+			context.set_forkserver_preload(['numpy', 'ViennaEnv'])
+
+		# environment indices of every worker & the worker, index within it of every environment
+		self.groups = [
+			group.tolist() for group in np.array_split(np.arange(len(env_fns)), workers)
+		]
+		self.locations = [
+			(worker, local)
+			for worker, group in enumerate(self.groups) for local in range(len(group))
+		]
+
+		self.remotes, self.processes = [], []
+		for worker, group in enumerate(self.groups):
+			remote, work_remote = context.Pipe()
+			process = context.Process(
+				target=worker_loop,
+				args=(
+					work_remote, remote, cloudpickle.dumps([env_fns[index] for index in group]),
+					cores[worker % len(cores)] if pin_cores else None
+				),
+				daemon=True,  # killed along with the parent
+			)
+			process.start()
+			work_remote.close()
+			self.remotes.append(remote)
+			self.processes.append(process)
+
+		self.waiting = False
+		self.closed = False
+
+		self.remotes[0].send(('get_spaces', None))
+		observation_space, action_space = self.remotes[0].recv()
+		super().__init__(len(env_fns), observation_space, action_space)
+
+	def reset(self) -> dict[str, np.ndarray] | np.ndarray:
+		for remote, group in zip(self.remotes, self.groups):
+			remote.send((
+				'reset',
+				(
+					[self._seeds[index] for index in group],
+					[self._options[index] for index in group]
+				)
+			))
+		observations = [remote.recv() for remote in self.remotes]
+
+		self._reset_seeds()
+		self._reset_options()
+		return self.concatenate(observations)
+
+	def step_async(self, actions: np.array):
+		for remote, group in zip(self.remotes, self.groups):
+			remote.send(('step', actions[group[0]:group[-1] + 1]))
+		self.waiting = True
+
+	def step_wait(self) -> tuple[dict, np.array, np.array, list[dict]]:
+		results = [remote.recv() for remote in self.remotes]
+		self.waiting = False
+
+		observations, rewards, dones, infos = zip(*results)
+		return (
+			self.concatenate(observations),
+			np.concatenate(rewards), np.concatenate(dones),
+			[info for worker_infos in infos for info in worker_infos]
+		)
+
+	def close(self):
+		if self.closed:
+			return
+		if self.waiting:
+			for remote in self.remotes:
+				remote.recv()
+		for remote in self.remotes:
+			remote.send(('close', None))
+		for process in self.processes:
+			process.join()
+		self.closed = True
+
+	def get_attr(self, attr_name: str, indices: Iterable[int] = None) -> list[Any]:
+		return self.call('get_attr', indices, lambda local: (attr_name, local))
+
+	def set_attr(self, attr_name: str, value: Any, indices: Iterable[int] = None):
+		self.call('set_attr', indices, lambda local: (attr_name, value, local))
+
+	def env_method(self,
+		method_name: str, *method_args, indices: Iterable[int] = None, **method_kwargs
+	) -> list[Any]:
+		return self.call(
+			'env_method', indices, lambda local: (method_name, method_args, method_kwargs, local)
+		)
+
+	def env_is_wrapped(self,
+		wrapper_class: type[gym.Wrapper], indices: Iterable[int] = None
+	) -> list[bool]:
+		return self.call('env_is_wrapped', indices, lambda local: (wrapper_class, local))
+
+	def call(self,
+		command: str, indices: Iterable[int], data: Callable[[list[int]], tuple]
+	) -> list:
+		"""
+		Sends a command to every worker holding one of the environments in `indices`.
+
+		:param data: Creates the command data from the indices within the worker.
+		:return: One result per environment, in the order of `indices`, `None` for commands that
+			return nothing.
+		"""
+		indices = self._get_indices(indices)
+		local = {}
+		for index in indices:
+			worker, local_index = self.locations[index]
+			local.setdefault(worker, []).append(local_index)
+
+		for worker, local_indices in local.items():
+			self.remotes[worker].send((command, data(local_indices)))
+		answers = {worker: self.remotes[worker].recv() for worker in local}
+
+		results = {}
+		for worker, local_indices in local.items():
+			worker_results = answers[worker]
+			if worker_results is None:
+				worker_results = [None] * len(local_indices)
+			for local_index, result in zip(local_indices, worker_results):
+				results[self.groups[worker][local_index]] = result
+		return [results[index] for index in indices]
+
+	@staticmethod
+	def concatenate(observations: list) -> dict[str, np.ndarray] | np.ndarray:
+		"""
+		Joins the batched observations of the workers, dict observations key by key.
+		"""
+		if isinstance(observations[0], dict):
+			return {
+				key: np.concatenate([batch[key] for batch in observations])
+				for key in observations[0]
+			}
+		return np.concatenate(observations)
+
+
+def make_parallel_env(
+	environment_count: int, environment_options: dict, workers: int = None,
+	start_method: str = 'forkserver', pin_cores: bool = False, seed: int = None
+) -> ParallelVecEnv:
+	"""
+	Creates `environment_count` `ViennaEnv` objects, wrapped in `Monitor` like `make_vec_env`
+	does, spread over worker processes. The distance matrix is created once in this process &
+	shared with every worker, see `distances.share_distance_matrix`.
+
+	:param environment_options: Keyword arguments of `ViennaEnv`.
+	:param seed: Seed of the 1st environment, the others get the following ones.
+	"""
+	options = dict(
+		environment_options,
+		shared_matrix=share_distance_matrix(environment_options.get('place_count', 80))
+	)
+
+	def make_env() -> gym.Env:
+		return Monitor(ViennaEnv(**options))
+
+	vec_env = ParallelVecEnv([make_env] * environment_count, workers, start_method, pin_cores)
+	if seed is not None:
+		vec_env.seed(seed)
+	return vec_env
@@ -0,0 +1,200 @@
+from typing import Any
+import os
+import queue
+import threading
+import numpy as np
+
+
+# kinds of events, stored by their index in the `kind` field
+event_kinds = ('dispatch', 'arrival', 'pickup', 'delivery')
+DISPATCH, ARRIVAL, PICKUP, DELIVERY = range(len(event_kinds))
+
+# layout of a single event, both in memory & in the trace file
+event_dtype = np.dtype([
+	('clock', np.int64),
+	('env', np.uint16),
+	('kind', np.uint8),
+	('vehicle', np.uint8),
+	('package', np.uint8),
+	('place', np.uint8),
+])
+
+
+class TraceRecorder:
+	def __init__(self, path: str = None, capacity: int = 65_536, flush_every: int = 8_192):
+		"""
+		Records dispatch, arrival, pickup & delivery events of `ViennaEnv` into a fixed size
+		ring buffer. This replaces verbose printing when looking for the reason an episode got
+		stuck, as recording a batch of events only costs a few array writes. Whenever
+		`flush_every` events have been recorded, they are handed to a background thread that
+		appends them to `path`, so the environment never waits on the disk.
+
+		:param path: File the events are appended to, read it back with `load_trace`. When left
+			empty, only the latest `capacity` events are kept in memory.
+		:param capacity: Number of events held in memory, older ones are overwritten.
+		:param flush_every: Number of events collected before they are written to the file.
+		"""
+		assert 0 < flush_every <= capacity, 'flush_every must be in the range of the capacity'
+
+		self.path = path
+		self.capacity = capacity
+		self.flush_every = flush_every
+
+		self.buffer = np.zeros(capacity, dtype=event_dtype)
+		self.count = 0  # total number of events recorded
+		self.flushed = 0  # number of events handed to the writer
+		self.dropped = 0  # events that never reached the file, as the writer fell behind
+		self.environments = 0  # number of environments registered
+
+		self.queue = None
+		self.writer = None
+		if path is not None:
+			self.queue = queue.Queue(maxsize=max(1, capacity // flush_every))
+			self.writer = threading.Thread(target=self.write_events, daemon=True)
+			self.writer.start()
+
+	def register(self) -> int:
+		"""
+		Called by every environment that records into this recorder.
+
+		:return: Id of the environment stored in the `env` field of its events.
+		"""
+		self.environments += 1
+		return self.environments - 1
+
+	def record(self,
+		kind: Any, clock: int, env: int,
+		vehicles: np.array, packages: Any = 0, places: Any = 0
+	):
+		"""
+		Adds a batch of events of the same time.
+
+		:param kind: One of `DISPATCH`, `ARRIVAL`, `PICKUP` or `DELIVERY`, or the kind of every
+			event.
+		:param vehicles: Vehicle of every event, the number of vehicles decides the number of
+			events.
+		:param packages: Package of every event, or a single package for all of them.
+		:param places: Place of every event, or a single place for all of them.
+		"""
+		amount = len(vehicles)
+		if amount == 0:
+			return
+
+		index = (self.count + np.arange(amount)) % self.capacity
+		self.buffer['clock'][index] = clock
+		self.buffer['env'][index] = env
+		self.buffer['kind'][index] = kind
+		self.buffer['vehicle'][index] = vehicles
+		self.buffer['package'][index] = packages
+		self.buffer['place'][index] = places
+		self.count += amount
+
+		if self.count - self.flushed >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+		"""
+		Hands every event that has not been written yet to the background writer. If the writer
+		is too far behind, the events are counted in `self.dropped` instead of waiting.
+		"""
+		if self.queue is None or self.count == self.flushed:
+			self.flushed = self.count
+			return
+
+		# events overwritten in the ring buffer before they could be flushed
+		start = max(self.flushed, self.count - self.capacity)
+		self.dropped += start - self.flushed
+
+		events = self.buffer[np.arange(start, self.count) % self.capacity]
+		try:
+			self.queue.put_nowait(events)
+		except queue.Full:
+			self.dropped += len(events)
+		self.flushed = self.count
+
+	def write_events(self):
+		"""
+		Loop of the background writer thread, stops when it receives `None`.
+		"""
+		with open(self.path, 'ab') as file:
+			while (events := self.queue.get()) is not None:
+				file.write(events.tobytes())
+				file.flush()
+
+	def close(self):
+		"""
+		Writes the remaining events & waits for the background writer to finish.
+		"""
+		if self.writer is None:
+			return
+
+		self.flush()
+		self.queue.put(None)
+		self.writer.join()
+		self.writer = None
+		self.queue = None
+
+	def events(self,
+		kind: str = None, env: int = None, vehicle: int = None, package: int = None
+	) -> np.array:
+		"""
+		Queries the events still held in memory, in the order they were recorded.
+
+		:param kind: Name of the event kind, see `event_kinds`.
+		:return: Structured array with the fields of `event_dtype`.
+		"""
+		start = max(0, self.count - self.capacity)
+		return filter_events(
+			self.buffer[np.arange(start, self.count) % self.capacity],
+			kind, env, vehicle, package
+		)
+
+	def __getstate__(self) -> dict:
+		# sent to a subprocess, every process writes its own file next to the original one
+		return {
+			'path': self.path, 'capacity': self.capacity, 'flush_every': self.flush_every
+		}
+
+	def __setstate__(self, state: dict):
+		if state['path'] is not None:
+			state['path'] = f'{state["path"]}.{os.getpid()}'
+		self.__init__(**state)
+
+
+def load_trace(path: str,
+	kind: str = None, env: int = None, vehicle: int = None, package: int = None
+) -> np.array:
+	"""
+	Reads the events written by a `TraceRecorder`, optionally filtered like
+	`TraceRecorder.events`.
+	"""
+	return filter_events(np.fromfile(path, dtype=event_dtype), kind, env, vehicle, package)
+
+
+def filter_events(events: np.array,
+	kind: str = None, env: int = None, vehicle: int = None, package: int = None
+) -> np.array:
+	"""
+	:return: Only the events matching every given field.
+	"""
+	mask = np.ones(len(events), dtype=bool)
+	if kind is not None:
+		mask &= events['kind'] == event_kinds.index(kind)
+	if env is not None:
+		mask &= events['env'] == env
+	if vehicle is not None:
+		mask &= events['vehicle'] == vehicle
+	if package is not None:
+		mask &= events['package'] == package
+	return events[mask]
+
+
+def format_events(events: np.array) -> str:
+	"""
+	:return: One readable line per event, like the old verbose output.
+	"""
+	return '\n'.join(
+		f'{event["clock"]:>8} env {event["env"]:<3} {event_kinds[event["kind"]]:<8} '
+		f'vehicle {event["vehicle"]:<3} package {event["package"]:<3} place {event["place"]}'
+		for event in events
+	)
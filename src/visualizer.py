@@ -5,7 +5,7 @@ from pygame import Color
 import numpy as np
 import random
 import colorsys
-from distances import create_distance_matrix
+from distances import get_distance_matrix
 import warnings
 
 class Visualizer:
@@ -27,7 +27,7 @@ class Visualizer:
 		self.vienna_map = pg.image.load('../images/vienna_blank3_scaled_darkened_more.png')
 		self.place_circle = pg.image.load('../images/place_circle_60.png')
 		self.place_circle_delivered = pg.image.load('../images/place_circle_delivered.png')
-		self.distance_matrix = create_distance_matrix(environment_arguments['place_count'])
+		self.distance_matrix = get_distance_matrix(environment_arguments['place_count'])
 		self.coordinates = pd.read_csv('../data/places/places.csv', sep=';')\
 			.loc[:environment_arguments['place_count']-1]
 		self.screen = pg.display.set_mode(self.canvas_size)
@@ -89,8 +89,10 @@ class Visualizer:
 		}
 		text_offset_x = 0
 		text_offset_y = 0
-		for stat, values in env_info.items():
-			if stat == 'p_carrying_vehicle': continue
+		for stat in env_info:
+			# keys without a display name are not drawn, & their lazy values are never computed
+			if stat == 'p_carrying_vehicle' or stat not in name: continue
+			values = env_info[stat]
 			
 			# move environment details to the right side of the screen
 			if stat == 'time':